@@ -31,6 +31,18 @@ def create_app(test_config=None):
 
     db.init_app(app)
 
+    from . import metrics
+
+    metrics.init_app(app)
+
+    from . import dashboard
+
+    dashboard.init_app(app)
+
+    from . import instrumentation
+
+    instrumentation.init_app(app)
+
     # --- Register Blueprints ---
     from . import routes_core
 
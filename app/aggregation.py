@@ -0,0 +1,379 @@
+import numpy as np
+from psycopg2.extras import DictCursor
+
+
+class BomMatrix:
+    """
+    Flattened BOMs as a dense matrix: one row per recipe, one column per
+    inventory item, each cell holding the raw quantity one batch of the
+    recipe consumes. Requirements for any production run are then a single
+    product of a batches vector (or a scenarios x recipes matrix) with it.
+    """
+
+    def __init__(self, items, recipe_ids, bom_rows):
+        self.items = items
+        self.item_index = {item["id"]: col for col, item in enumerate(items)}
+        self.recipe_index = {rid: row for row, rid in enumerate(recipe_ids)}
+
+        self.matrix = np.zeros((len(recipe_ids), len(items)))
+        for bom in bom_rows:
+            self.matrix[
+                self.recipe_index[bom["recipe_id"]],
+                self.item_index[bom["inventory_item_id"]],
+            ] = float(bom["quantity"])
+
+        self.on_hand = np.array([float(item["on_hand"] or 0) for item in items])
+        self.allocated = np.array([float(item["allocated"] or 0) for item in items])
+        self.available = self.on_hand - self.allocated
+
+    @classmethod
+    def load(cls, conn, recipe_ids=None):
+        """
+        Builds the matrix from recipe_base_ingredients with two queries.
+        Limit it to 'recipe_ids' when only a few recipes are needed.
+        """
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(
+                """SELECT id, TRIM(name) AS name, TRIM(unit) AS unit,
+                          quantity_on_hand AS on_hand, quantity_allocated AS allocated
+                   FROM inventory_items ORDER BY id;"""
+            )
+            items = cur.fetchall()
+            if recipe_ids is None:
+                cur.execute(
+                    "SELECT recipe_id, inventory_item_id, quantity FROM recipe_base_ingredients;"
+                )
+            else:
+                cur.execute(
+                    """SELECT recipe_id, inventory_item_id, quantity
+                       FROM recipe_base_ingredients WHERE recipe_id = ANY(%s);""",
+                    (list(recipe_ids),),
+                )
+            bom_rows = cur.fetchall()
+
+        if recipe_ids is None:
+            recipe_ids = sorted({bom["recipe_id"] for bom in bom_rows})
+        return cls(items, list(dict.fromkeys(recipe_ids)), bom_rows)
+
+    def batch_vector(self, batches_to_make):
+        """
+        Turns (recipe_id, batches) pairs into a vector over the recipe rows.
+        Recipes without a materialized BOM contribute nothing.
+        """
+        batches = np.zeros(len(self.recipe_index))
+        for recipe_id, count in batches_to_make:
+            row = self.recipe_index.get(recipe_id)
+            if row is not None:
+                batches[row] += count
+        return batches
+
+    def total_needed(self, batches):
+        """Raw quantities needed; 'batches' may be a vector or a 2-D matrix."""
+        return batches @ self.matrix
+
+    def net_needed(self, batches):
+        return np.maximum(self.total_needed(batches) - self.available, 0)
+
+    def item_rows(self, totals, include):
+        """
+        Builds report rows for the item columns selected by the 'include'
+        mask, sorted by name.
+        """
+        rows = []
+        for col in np.flatnonzero(include):
+            item = self.items[col]
+            total_needed = float(totals[col])
+            available = float(self.available[col])
+            rows.append(
+                {
+                    "inventory_item_id": item["id"],
+                    "name": item["name"],
+                    "unit": item["unit"],
+                    "total_needed": round(total_needed, 2),
+                    "on_hand": round(float(self.on_hand[col]), 2),
+                    "allocated": round(float(self.allocated[col]), 2),
+                    "available": round(available, 2),
+                    "net_needed": round(max(0, total_needed - available), 2),
+                }
+            )
+        return sorted(rows, key=lambda x: x["name"])
+
+
+def load_product_needs(conn):
+    """
+    Per-product stock minimum and location stock totals, for every product
+    that has minimums and a usable jars_per_batch.
+    """
+    with conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute(
+            """
+            SELECT p.id AS product_id, p.recipe_id, p.jars_per_batch,
+                   sm.total_min, COALESCE(ls.total_stock, 0) AS total_stock
+            FROM (
+                SELECT product_id, SUM(min_jars) AS total_min
+                FROM stock_minimums GROUP BY product_id
+            ) sm
+            JOIN products p ON p.id = sm.product_id
+            LEFT JOIN (
+                SELECT product_id, SUM(quantity) AS total_stock
+                FROM location_stock GROUP BY product_id
+            ) ls ON ls.product_id = sm.product_id
+            WHERE p.jars_per_batch IS NOT NULL AND p.jars_per_batch > 0;
+        """
+        )
+        return cur.fetchall()
+
+
+def scenario_batches(product_needs, multipliers):
+    """
+    Batches of each product needed under every forecast multiplier, as a
+    scenarios x products matrix. Mirrors the requirements report: scale the
+    minimums, subtract finished stock, round up to whole batches.
+    """
+    mins = np.array([float(p["total_min"]) for p in product_needs])
+    stocks = np.array([float(p["total_stock"]) for p in product_needs])
+    jars_per_batch = np.array([float(p["jars_per_batch"]) for p in product_needs])
+
+    jars = np.maximum(np.outer(multipliers, mins) - stocks, 0)
+    # Round away float noise (e.g. 10 * 1.1) before taking the ceiling.
+    return np.ceil(np.round(jars / jars_per_batch, 9))
+
+
+def compare_scenarios(conn, multipliers):
+    """
+    Net requirements for several forecast multipliers at once. The product
+    needs, BOM matrix and inventory snapshot are loaded once and shared.
+    Returns one row per inventory item short in at least one scenario, with
+    per-scenario 'total_needed' and 'net_needed' lists.
+    """
+    product_needs = load_product_needs(conn)
+    recipe_ids = [p["recipe_id"] for p in product_needs]
+    bom = BomMatrix.load(conn, recipe_ids)
+
+    # products -> recipe rows, so several products may share one recipe.
+    product_to_recipe = np.zeros((len(product_needs), len(bom.recipe_index)))
+    for col, recipe_id in enumerate(recipe_ids):
+        product_to_recipe[col, bom.recipe_index[recipe_id]] = 1
+
+    batches = scenario_batches(product_needs, multipliers) @ product_to_recipe
+    totals = bom.total_needed(batches)
+    net = np.maximum(totals - bom.available, 0)
+
+    rows = []
+    for col in np.flatnonzero((net > 0).any(axis=0)):
+        item = bom.items[col]
+        rows.append(
+            {
+                "inventory_item_id": item["id"],
+                "name": item["name"],
+                "unit": item["unit"],
+                "available": round(float(bom.available[col]), 2),
+                "total_needed": [round(float(t), 2) for t in totals[:, col]],
+                "net_needed": [round(float(n), 2) for n in net[:, col]],
+            }
+        )
+    return sorted(rows, key=lambda x: x["name"])
+
+
+def load_sellable_products(conn):
+    """Sold products with a usable jars_per_batch, ordered by name."""
+    with conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute(
+            """SELECT p.id, p.sku, p.product_name, p.jars_per_batch, r.id as recipe_id, r.name as recipe_name FROM products p JOIN recipes r ON p.recipe_id = r.id WHERE r.is_sold_product = TRUE AND p.jars_per_batch IS NOT NULL AND p.jars_per_batch > 0 ORDER BY p.product_name;"""
+        )
+        return cur.fetchall()
+
+
+def _batch_ratios(usage, available):
+    """Batches of each row's recipe every single ingredient would cover."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(usage > 0, np.maximum(available, 0) / usage, np.inf)
+
+
+def producible_batches(usage, available):
+    """
+    Whole batches each row of 'usage' (per-batch raw quantities, one row
+    per recipe) could make from 'available' stock on its own, limited by
+    its scarcest ingredient. Rows that use nothing come back as inf.
+    """
+    ratios = _batch_ratios(usage, available)
+    if ratios.shape[1] == 0:
+        return np.full(ratios.shape[0], np.inf)
+    return np.floor(np.round(ratios.min(axis=1), 9))
+
+
+def joint_batches(usage, available, weights):
+    """
+    Whole batches per row that together maximise sum(weights * batches)
+    without any ingredient exceeding 'available' stock: a small integer
+    program solved locally with HiGHS. Rows that use nothing stay at 0.
+    """
+    # Only this mode needs SciPy, so it is imported on first use.
+    from scipy.optimize import linprog
+
+    batches = np.zeros(len(usage))
+    uses_stock = usage.any(axis=1)
+    if not uses_stock.any():
+        return batches
+
+    result = linprog(
+        c=-weights[uses_stock],
+        A_ub=usage[uses_stock].T,
+        b_ub=np.maximum(available, 0),
+        bounds=(0, None),
+        integrality=np.ones(int(uses_stock.sum())),
+        method="highs",
+        options={"time_limit": 5},
+    )
+    if result.x is None:
+        raise ValueError(f"Joint allocation could not be solved: {result.message}")
+    batches[uses_stock] = np.floor(np.round(result.x, 9))
+    return batches
+
+
+def max_producible(conn, joint=False):
+    """
+    The most batches (and jars) of every sellable product that available
+    stock (on hand minus allocated) supports, each product considered on
+    its own, with the ingredient that limits it. With 'joint', also a
+    combined plan that shares the stock across products to make the most
+    jars in total.
+    """
+    products = load_sellable_products(conn)
+    bom = BomMatrix.load(conn, [p["recipe_id"] for p in products])
+    usage = bom.matrix[[bom.recipe_index[p["recipe_id"]] for p in products]]
+    jars_per_batch = np.array([float(p["jars_per_batch"]) for p in products])
+
+    batches = producible_batches(usage, bom.available)
+    if bom.items:
+        bottlenecks = _batch_ratios(usage, bom.available).argmin(axis=1)
+    combined = joint_batches(usage, bom.available, jars_per_batch) if joint else None
+
+    rows = []
+    for row, product in enumerate(products):
+        has_bom = np.isfinite(batches[row])
+        rows.append(
+            {
+                "id": product["id"],
+                "product_name": product["product_name"],
+                "sku": product["sku"],
+                "jars_per_batch": float(product["jars_per_batch"]),
+                "batches": int(batches[row]) if has_bom else None,
+                "jars": int(batches[row] * jars_per_batch[row]) if has_bom else None,
+                "bottleneck": (
+                    bom.items[bottlenecks[row]]["name"] if has_bom else None
+                ),
+                "joint_batches": (
+                    int(combined[row]) if combined is not None and has_bom else None
+                ),
+                "joint_jars": (
+                    int(combined[row] * jars_per_batch[row])
+                    if combined is not None and has_bom
+                    else None
+                ),
+            }
+        )
+    return rows
+
+
+def _consumers_by_item(usage):
+    """Index of item column -> rows of 'usage' that consume it."""
+    consumers = {}
+    for row, col in zip(*np.nonzero(usage)):
+        consumers.setdefault(col, []).append(row)
+    return consumers
+
+
+def shortage_impact(conn, multiplier=1):
+    """
+    For every inventory item with a positive net need (as in the
+    requirements report), the sold products and in-progress WIP batches
+    that consume it. Products carry how many batches current stock still
+    covers; WIP batches carry what they need of the item and what is
+    already allocated. Built from one BOM matrix load: the item -> product
+    usage index is just the non-zero cells of the products x items matrix.
+    """
+    product_needs = load_product_needs(conn)
+    products = load_sellable_products(conn)
+    with conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute(
+            """SELECT w.id, w.recipe_id, w.batch_type,
+                      COALESCE(p.product_name, i.name) AS producing
+               FROM wip_batches w
+               LEFT JOIN products p ON w.product_id = p.id
+               LEFT JOIN inventory_items i ON w.inventory_item_id = i.id
+               WHERE w.status = 'In Progress'
+               ORDER BY w.id;"""
+        )
+        wip_batches = cur.fetchall()
+        cur.execute(
+            """SELECT a.wip_batch_id, a.inventory_item_id,
+                      SUM(a.quantity_allocated) AS allocated
+               FROM wip_allocations a
+               JOIN wip_batches w ON w.id = a.wip_batch_id
+               WHERE w.status = 'In Progress'
+               GROUP BY a.wip_batch_id, a.inventory_item_id;"""
+        )
+        wip_allocated = {
+            (row["wip_batch_id"], row["inventory_item_id"]): float(row["allocated"])
+            for row in cur.fetchall()
+        }
+
+    bom = BomMatrix.load(
+        conn,
+        [p["recipe_id"] for p in product_needs]
+        + [p["recipe_id"] for p in products]
+        + [w["recipe_id"] for w in wip_batches],
+    )
+    if not bom.items:
+        return []
+
+    needed_batches = scenario_batches(product_needs, [multiplier])[0]
+    totals = bom.total_needed(
+        bom.batch_vector(zip([p["recipe_id"] for p in product_needs], needed_batches))
+    )
+    net = np.maximum(totals - bom.available, 0)
+
+    product_usage = bom.matrix[[bom.recipe_index[p["recipe_id"]] for p in products]]
+    product_batches = producible_batches(product_usage, bom.available)
+    wip_usage = bom.matrix[[bom.recipe_index[w["recipe_id"]] for w in wip_batches]]
+    product_users = _consumers_by_item(product_usage)
+    wip_users = _consumers_by_item(wip_usage)
+
+    rows = []
+    for col in np.flatnonzero(net > 0):
+        item = bom.items[col]
+        rows.append(
+            {
+                "inventory_item_id": item["id"],
+                "name": item["name"],
+                "unit": item["unit"],
+                "available": round(float(bom.available[col]), 2),
+                "total_needed": round(float(totals[col]), 2),
+                "net_needed": round(float(net[col]), 2),
+                "products": [
+                    {
+                        "id": products[row]["id"],
+                        "product_name": products[row]["product_name"],
+                        "sku": products[row]["sku"],
+                        "per_batch": round(float(product_usage[row, col]), 2),
+                        "batches_possible": int(product_batches[row]),
+                    }
+                    for row in product_users.get(col, [])
+                ],
+                "wip_batches": [
+                    {
+                        "id": wip_batches[row]["id"],
+                        "producing": wip_batches[row]["producing"],
+                        "batch_type": wip_batches[row]["batch_type"],
+                        "needed": round(float(wip_usage[row, col]), 2),
+                        "allocated": round(
+                            wip_allocated.get((wip_batches[row]["id"], item["id"]), 0),
+                            2,
+                        ),
+                    }
+                    for row in wip_users.get(col, [])
+                ],
+            }
+        )
+    return sorted(rows, key=lambda x: x["name"])
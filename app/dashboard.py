@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+
+import psycopg2
+from flask import request
+from psycopg2.extras import DictCursor
+
+from app.db import _int_env, get_db_connection
+from app.versions import versions_key
+
+logger = logging.getLogger(__name__)
+
+# Everything the home page cards are computed from.
+DASHBOARD_DOMAINS = (
+    "inventory",
+    "recipes",
+    "products",
+    "stock_minimums",
+    "purchase_orders",
+    "wip",
+)
+
+
+def compute_dashboard_data(conn):
+    """
+    Runs the queries behind the home page cards.
+    """
+    dashboard_data = {"wip_batches_count": 0, "open_pos_count": 0, "low_stock_count": 0}
+    with conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute(
+            "SELECT COUNT(id) as count FROM wip_batches WHERE status = 'In Progress';"
+        )
+        dashboard_data["wip_batches_count"] = cur.fetchone()["count"]
+        cur.execute(
+            "SELECT COUNT(id) as count FROM purchase_orders WHERE status = 'Placed' OR status = 'Shipped';"
+        )
+        dashboard_data["open_pos_count"] = cur.fetchone()["count"]
+        cur.execute(
+            """
+            WITH batches AS (
+                SELECT p.recipe_id,
+                       CEIL(SUM(sm.min_jars)::numeric / p.jars_per_batch) AS batches_needed
+                FROM stock_minimums sm
+                JOIN products p ON sm.product_id = p.id
+                JOIN recipes r ON p.recipe_id = r.id
+                WHERE r.is_sold_product = TRUE AND p.jars_per_batch IS NOT NULL AND p.jars_per_batch > 0
+                GROUP BY p.recipe_id, p.jars_per_batch
+            ),
+            needs AS (
+                SELECT rbi.inventory_item_id, SUM(rbi.quantity * b.batches_needed) AS total_needed
+                FROM batches b
+                JOIN recipe_base_ingredients rbi ON rbi.recipe_id = b.recipe_id
+                GROUP BY rbi.inventory_item_id
+            )
+            SELECT COUNT(*) as count
+            FROM needs n
+            JOIN inventory_items inv ON inv.id = n.inventory_item_id
+            WHERE n.total_needed > inv.quantity_on_hand - inv.quantity_allocated;
+        """
+        )
+        dashboard_data["low_stock_count"] = cur.fetchone()["count"]
+    return dashboard_data
+
+
+class DashboardSnapshot:
+    """
+    Keeps a precomputed copy of the dashboard data. A daemon thread rebuilds
+    it every 'interval' seconds, or sooner when request_refresh() is called
+    after a write, but only reruns the queries when the data versions of
+    DASHBOARD_DOMAINS have moved. With an interval of 0 or less no thread is
+    started and callers are expected to compute the data inline.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._data = None
+        self._computed_at = None
+        self._versions = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def ensure_started(self):
+        # Started lazily from a request so each (forked) worker gets its own.
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="dashboard-snapshot", daemon=True
+                )
+                self._thread.start()
+
+    def get(self):
+        """Returns (dashboard_data, age_in_seconds), or (None, None)."""
+        with self._lock:
+            if self._data is None:
+                return None, None
+            return dict(self._data), time.time() - self._computed_at
+
+    def store(self, dashboard_data, versions=None):
+        with self._lock:
+            self._data = dict(dashboard_data)
+            self._computed_at = time.time()
+            self._versions = versions
+
+    def request_refresh(self):
+        self._wake.set()
+
+    def refresh(self):
+        conn = get_db_connection()
+        try:
+            try:
+                versions = versions_key(conn, DASHBOARD_DOMAINS)
+            except psycopg2.Error:
+                # e.g. migrations not applied yet: always recompute.
+                conn.rollback()
+                versions = None
+            with self._lock:
+                if versions is not None and versions == self._versions:
+                    # Nothing changed since the last build; it is still current.
+                    self._computed_at = time.time()
+                    return
+            self.store(compute_dashboard_data(conn), versions)
+        finally:
+            conn.rollback()
+            conn.close()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                self.refresh()
+            except (psycopg2.Error, RuntimeError) as e:
+                logger.warning("Dashboard snapshot refresh failed: %s", e)
+            self._wake.wait(self.interval)
+
+
+dashboard_snapshot = DashboardSnapshot(_int_env("DASHBOARD_REFRESH_SECONDS", 60))
+
+
+def _refresh_after_write(response):
+    if request.method == "POST" and response.status_code < 400:
+        dashboard_snapshot.request_refresh()
+    return response
+
+
+def init_app(app):
+    """
+    Register the snapshot refresh hook with the Flask app.
+    """
+    app.after_request(_refresh_after_write)
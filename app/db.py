@@ -3,13 +3,72 @@ import os
 import time
 from urllib.parse import urlparse
 
+import click
 import psycopg2
-from flask import g
-from sqlalchemy import create_engine
+from flask import current_app, g
+from sqlalchemy import create_engine, event
 from sqlalchemy.exc import OperationalError as SAOperationalError
+from sqlalchemy.exc import TimeoutError as SATimeoutError
+
+from app.metrics import registry
 
 logger = logging.getLogger(__name__)
 _engine = None
+_max_overflow = None
+
+# --- Pool metrics (served at /metrics) ---
+_checkout_seconds = registry.histogram(
+    "db_pool_checkout_seconds",
+    "Time to get a connection from the pool, including pre-ping and connect.",
+)
+_connect_failures = registry.counter(
+    "db_connect_attempt_failures",
+    "Connection attempts that failed and were retried or given up on.",
+)
+_connect_errors = registry.counter(
+    "db_connect_errors", "get_db_connection calls that failed after all retries."
+)
+_pool_timeouts = registry.counter(
+    "db_pool_timeouts", "Checkouts that timed out waiting for a free connection."
+)
+_invalidations = registry.counter(
+    "db_pool_invalidations",
+    "Pooled connections discarded as dead, e.g. by a failed pre-ping.",
+)
+_hold_seconds = registry.histogram(
+    "db_request_connection_hold_seconds",
+    "Time a request held its connection before returning it to the pool.",
+)
+_connections_opened = registry.counter(
+    "db_pool_connections_opened", "New database connections opened by the pool."
+)
+
+
+def _pool_gauges():
+    if _engine is None:
+        return {}
+    pool = _engine.pool
+    return {
+        "db_pool_size": ("Configured number of pooled connections.", pool.size()),
+        "db_pool_max_overflow": (
+            "Configured connections allowed beyond the pool size.",
+            _max_overflow,
+        ),
+        "db_pool_checked_out": (
+            "Connections currently checked out.",
+            pool.checkedout(),
+        ),
+        "db_pool_checked_in": ("Idle connections in the pool.", pool.checkedin()),
+        "db_pool_overflow": (
+            "Connections currently open beyond the pool size.",
+            max(pool.overflow(), 0),
+        ),
+    }
+
+
+registry.register_gauges(_pool_gauges)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
 
 
 def _int_env(name, default):
@@ -29,7 +88,7 @@ def _describe_target(conn_string):
 
 
 def _get_engine(conn_string):
-    global _engine
+    global _engine, _max_overflow
     if _engine is not None:
         return _engine
 
@@ -46,6 +105,9 @@ def _get_engine(conn_string):
         pool_recycle=pool_recycle,
         connect_args={"connect_timeout": connect_timeout},
     )
+    _max_overflow = max_overflow
+    event.listen(_engine, "connect", lambda *args: _connections_opened.inc())
+    event.listen(_engine, "invalidate", lambda *args: _invalidations.inc())
     return _engine
 
 
@@ -64,9 +126,16 @@ def get_db_connection():
     engine = _get_engine(conn_string)
 
     for attempt in range(1, max_attempts + 1):
+        start = time.perf_counter()
         try:
-            return engine.raw_connection()
+            conn = engine.raw_connection()
+            _checkout_seconds.observe(time.perf_counter() - start)
+            return conn
+        except SATimeoutError:
+            _pool_timeouts.inc()
+            raise
         except (psycopg2.OperationalError, SAOperationalError) as exc:
+            _connect_failures.inc()
             last_exception = exc
             logger.warning(
                 "Database connection attempt %s/%s to %s failed: %s",
@@ -78,26 +147,111 @@ def get_db_connection():
             if attempt < max_attempts:
                 time.sleep(0.25 * attempt)
 
+    _connect_errors.inc()
     raise RuntimeError(f"Could not connect to {safe_target}") from last_exception
 
 
-def get_db():
+def get_db(read_only=False):
     """
     Opens a new database connection if one is not already open
-    for the current request.
+    for the current request. With read_only=True a newly opened
+    connection runs in autocommit mode, so the route's SELECTs do not
+    hold a transaction open; it has no effect on an already open one.
     """
+    if g.get("db_released"):
+        raise RuntimeError(
+            "The database connection for this request was already released."
+        )
     if "db" not in g:
-        g.db = get_db_connection()
+        conn = get_db_connection()
+        if read_only:
+            # The pool proxy does not forward attribute writes.
+            conn.rollback()  # End the pool's pre-ping transaction.
+            conn.dbapi_connection.autocommit = True
+        wrapper = current_app.extensions.get("db_connection_wrapper")
+        g.db = wrapper(conn) if wrapper else conn
+        g.db_acquired_at = time.perf_counter()
     return g.db
 
 
+def _return_db():
+    db = g.pop("db", None)
+    if db is None:
+        return
+    _hold_seconds.observe(time.perf_counter() - g.pop("db_acquired_at"))
+    try:
+        if db.autocommit:
+            # Pooled connections are expected to start transactional.
+            db.dbapi_connection.autocommit = False
+    finally:
+        db.close()
+
+
+def release_db():
+    """
+    Returns the request's connection to the pool as soon as a route has
+    gathered its data, instead of holding it while the template renders.
+    Any later get_db() in the same request raises RuntimeError.
+    """
+    _return_db()
+    g.db_released = True
+
+
 def close_db(e=None):
     """
     Closes the database connection at the end of the request.
     """
-    db = g.pop("db", None)
-    if db is not None:
-        db.close()
+    _return_db()
+
+
+def apply_migrations(conn):
+    """
+    Runs every .sql file in the migrations folder that has not been
+    applied yet, in filename order, one transaction per file.
+    Returns the names of the files that were applied.
+    """
+    applied_now = []
+    with conn.cursor() as cur:
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS schema_migrations (
+                name TEXT PRIMARY KEY,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            );"""
+        )
+        cur.execute("SELECT name FROM schema_migrations;")
+        applied = {row[0] for row in cur.fetchall()}
+        conn.commit()
+
+        for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+            if not filename.endswith(".sql") or filename in applied:
+                continue
+            with open(os.path.join(MIGRATIONS_DIR, filename)) as f:
+                cur.execute(f.read())
+            cur.execute(
+                "INSERT INTO schema_migrations (name) VALUES (%s);", (filename,)
+            )
+            conn.commit()
+            applied_now.append(filename)
+    return applied_now
+
+
+@click.command("migrate-db")
+def migrate_db_command():
+    """Apply pending SQL migrations from app/migrations."""
+    conn = get_db_connection()
+    try:
+        applied = apply_migrations(conn)
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    if applied:
+        for name in applied:
+            click.echo(f"Applied {name}")
+    else:
+        click.echo("Database schema is up to date.")
 
 
 def init_app(app):
@@ -106,3 +260,4 @@ def init_app(app):
     the application factory.
     """
     app.teardown_appcontext(close_db)
+    app.cli.add_command(migrate_db_command)
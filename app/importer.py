@@ -0,0 +1,372 @@
+import csv
+import io
+import math
+from abc import ABC, abstractmethod
+from itertools import islice
+
+from psycopg2.extras import DictCursor, execute_values
+
+from app.models import _log_inventory_adjustments
+from app.versions import bump_version
+
+# --- Bulk CSV import ---
+# An uploaded file is read one record at a time and handled in chunks:
+# each chunk is checked against the database with one lookup query for
+# all the keys it references, then written with multi-row statements.
+# Rows that fail validation are reported by line number and skipped; the
+# rest load in a single transaction, which the caller commits.
+
+IMPORT_CHUNK_SIZE = 500
+# Errors past this many are counted but not listed.
+MAX_REPORTED_ERRORS = 200
+
+
+class ImportResult:
+    def __init__(self, label):
+        self.label = label
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.errors = []
+        self.error_count = 0
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    @property
+    def loaded(self):
+        return self.inserted + self.updated + self.unchanged
+
+
+def read_csv(stream, columns, required):
+    """
+    Yields (line number, {column: stripped value}) for each record of an
+    uploaded CSV file. Headers are matched case-insensitively; unknown
+    columns are ignored. Raises ValueError if a required column is
+    missing or the file cannot be read as UTF-8 CSV.
+    """
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    reader = csv.DictReader(text)
+    try:
+        headers = {
+            name.strip().lower(): name for name in reader.fieldnames or () if name
+        }
+        if not headers:
+            raise ValueError("The file is empty.")
+        missing = [column for column in required if column not in headers]
+        if missing:
+            raise ValueError(f"Missing required column(s): {', '.join(missing)}.")
+        for record in reader:
+            if not any(
+                isinstance(value, str) and value.strip() for value in record.values()
+            ):
+                continue  # A row of empty cells.
+            yield reader.line_num, {
+                column: (record.get(headers[column]) or "").strip()
+                for column in columns
+                if column in headers
+            }
+    except UnicodeDecodeError as e:
+        raise ValueError("The file is not UTF-8 encoded text.") from e
+    except csv.Error as e:
+        raise ValueError(f"Line {reader.line_num}: {e}") from e
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def _required(row, column):
+    value = row.get(column, "")
+    if not value:
+        raise ValueError(f"'{column}' is required.")
+    return value
+
+
+def _number(row, column, integer=False):
+    """Parses an optional non-negative number; blank gives None."""
+    value = row.get(column, "")
+    if not value:
+        return None
+    try:
+        number = int(value) if integer else float(value)
+    except ValueError:
+        kind = "a whole number" if integer else "a number"
+        raise ValueError(f"'{column}' must be {kind}, got '{value}'.")
+    if not math.isfinite(number):
+        raise ValueError(f"'{column}' must be a number, got '{value}'.")
+    if number < 0:
+        raise ValueError(f"'{column}' cannot be negative.")
+    return number
+
+
+class CsvImport(ABC):
+    """
+    Base for one kind of import. Subclasses list their 'columns' (with
+    'required' a subset), the data version 'domains' they write, and
+    implement parse_row() and load_chunk().
+    """
+
+    label = ""
+    description = ""
+    columns = ()
+    required = ()
+    domains = ()
+
+    @abstractmethod
+    def parse_row(self, row):
+        """Returns (key, values) for a row or raises ValueError."""
+
+    @abstractmethod
+    def load_chunk(self, cur, rows, result):
+        """Writes a chunk of parsed (line, key, values) rows."""
+
+    def run(self, conn, stream, chunk_size=IMPORT_CHUNK_SIZE):
+        result = ImportResult(self.label)
+        first_seen = {}
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            records = read_csv(stream, self.columns, self.required)
+            for chunk in _chunks(records, chunk_size):
+                rows = []
+                for line, row in chunk:
+                    try:
+                        key, values = self.parse_row(row)
+                    except ValueError as e:
+                        result.error(line, str(e))
+                        continue
+                    if key in first_seen:
+                        result.error(line, f"Duplicate of line {first_seen[key]}.")
+                        continue
+                    first_seen[key] = line
+                    rows.append((line, key, values))
+                if rows:
+                    self.load_chunk(cur, rows, result)
+            if result.inserted or result.updated:
+                bump_version(cur, *self.domains)
+        result.errors.sort()
+        return result
+
+
+class InventoryItemImport(CsvImport):
+    label = "Inventory items"
+    description = (
+        "Adds items by name and unit. For an item that already exists, a "
+        "quantity_on_hand sets its stock and is logged as an adjustment."
+    )
+    columns = ("name", "unit", "quantity_on_hand")
+    required = ("name", "unit")
+    domains = ("inventory",)
+
+    def parse_row(self, row):
+        name, unit = _required(row, "name"), _required(row, "unit")
+        quantity = _number(row, "quantity_on_hand")
+        return (name.lower(), unit.lower()), (name, unit, quantity)
+
+    def load_chunk(self, cur, rows, result):
+        keys = [key for _, key, _ in rows]
+        cur.execute(
+            """SELECT id, LOWER(name) AS name_key, LOWER(unit) AS unit_key,
+                      quantity_on_hand
+               FROM inventory_items
+               WHERE (LOWER(name), LOWER(unit)) IN (
+                   SELECT * FROM unnest(%s::text[], %s::text[])
+               )
+               ORDER BY id FOR UPDATE;""",
+            ([name for name, _ in keys], [unit for _, unit in keys]),
+        )
+        existing = {}
+        for item in cur.fetchall():
+            existing.setdefault((item["name_key"], item["unit_key"]), item)
+
+        inserts, updates, adjustments = [], [], []
+        for line, key, (name, unit, quantity) in rows:
+            item = existing.get(key)
+            if item is None:
+                inserts.append((name, unit, quantity or 0.0))
+                continue
+            on_hand = float(item["quantity_on_hand"] or 0)
+            if quantity is None or quantity == on_hand:
+                result.unchanged += 1
+            else:
+                updates.append((item["id"], quantity))
+                adjustments.append(
+                    {
+                        "inventory_item_id": item["id"],
+                        "adjustment_quantity": quantity - on_hand,
+                        "new_quantity": quantity,
+                        "reason": "CSV import",
+                    }
+                )
+
+        if inserts:
+            execute_values(
+                cur,
+                "INSERT INTO inventory_items (name, unit, quantity_on_hand) VALUES %s;",
+                inserts,
+                page_size=len(inserts),
+            )
+            result.inserted += len(inserts)
+        if updates:
+            execute_values(
+                cur,
+                """UPDATE inventory_items AS inv
+                   SET quantity_on_hand = v.quantity
+                   FROM (VALUES %s) AS v(id, quantity)
+                   WHERE inv.id = v.id;""",
+                updates,
+                template="(%s::int, %s::numeric)",
+                page_size=len(updates),
+            )
+            _log_inventory_adjustments(cur, adjustments)
+            result.updated += len(updates)
+
+
+class ProductImport(CsvImport):
+    label = "Products"
+    description = (
+        "Adds or updates products by SKU. 'recipe' is the name of a sold "
+        "recipe; blank optional columns leave an existing product's value."
+    )
+    columns = ("sku", "product_name", "recipe", "jars_per_batch")
+    required = ("sku", "recipe")
+    domains = ("products",)
+
+    def parse_row(self, row):
+        sku, recipe = _required(row, "sku"), _required(row, "recipe")
+        product_name = row.get("product_name") or None
+        jars_per_batch = _number(row, "jars_per_batch", integer=True)
+        return sku.lower(), (sku, product_name, recipe, jars_per_batch)
+
+    def load_chunk(self, cur, rows, result):
+        recipe_names = sorted({values[2].lower() for _, _, values in rows})
+        cur.execute(
+            """SELECT 'product' AS kind, id, LOWER(sku) AS key
+               FROM products WHERE LOWER(sku) = ANY(%s)
+               UNION ALL
+               SELECT 'recipe', id, LOWER(name)
+               FROM recipes WHERE LOWER(name) = ANY(%s) AND is_sold_product
+               ORDER BY id;""",
+            ([key for _, key, _ in rows], recipe_names),
+        )
+        found = {"product": {}, "recipe": {}}
+        for match in cur.fetchall():
+            found[match["kind"]].setdefault(match["key"], match["id"])
+
+        inserts, updates = [], []
+        for line, key, (sku, product_name, recipe, jars_per_batch) in rows:
+            recipe_id = found["recipe"].get(recipe.lower())
+            if recipe_id is None:
+                result.error(line, f"No sold recipe named '{recipe}'.")
+                continue
+            product_id = found["product"].get(key)
+            if product_id is None:
+                inserts.append((sku, product_name, recipe_id, jars_per_batch))
+            else:
+                updates.append((product_id, product_name, recipe_id, jars_per_batch))
+
+        if inserts:
+            execute_values(
+                cur,
+                "INSERT INTO products (sku, product_name, recipe_id, jars_per_batch) VALUES %s;",
+                inserts,
+                page_size=len(inserts),
+            )
+            result.inserted += len(inserts)
+        if updates:
+            # Rows whose values already match are left alone and counted
+            # as unchanged.
+            changed = execute_values(
+                cur,
+                """UPDATE products AS p
+                   SET product_name = COALESCE(v.product_name, p.product_name),
+                       recipe_id = v.recipe_id,
+                       jars_per_batch = COALESCE(v.jars_per_batch, p.jars_per_batch)
+                   FROM (VALUES %s) AS v(id, product_name, recipe_id, jars_per_batch)
+                   WHERE p.id = v.id
+                     AND (p.product_name, p.recipe_id, p.jars_per_batch)
+                         IS DISTINCT FROM (
+                             COALESCE(v.product_name, p.product_name),
+                             v.recipe_id,
+                             COALESCE(v.jars_per_batch, p.jars_per_batch)
+                         )
+                   RETURNING p.id;""",
+                updates,
+                template="(%s::int, %s::text, %s::int, %s::int)",
+                page_size=len(updates),
+                fetch=True,
+            )
+            result.updated += len(changed)
+            result.unchanged += len(updates) - len(changed)
+
+
+class StockMinimumImport(CsvImport):
+    label = "Stock minimums"
+    description = (
+        "Sets the minimum jars of a product (by SKU) at a location (by "
+        "name), replacing any existing minimum."
+    )
+    columns = ("location", "sku", "min_jars")
+    required = ("location", "sku", "min_jars")
+    domains = ("stock_minimums",)
+
+    def parse_row(self, row):
+        location, sku = _required(row, "location"), _required(row, "sku")
+        _required(row, "min_jars")
+        min_jars = _number(row, "min_jars", integer=True)
+        return (location.lower(), sku.lower()), (location, sku, min_jars)
+
+    def load_chunk(self, cur, rows, result):
+        cur.execute(
+            """SELECT 'location' AS kind, id, LOWER(name) AS key
+               FROM locations WHERE LOWER(name) = ANY(%s)
+               UNION ALL
+               SELECT 'product', id, LOWER(sku)
+               FROM products WHERE LOWER(sku) = ANY(%s)
+               ORDER BY id;""",
+            (
+                sorted({location for _, (location, _), _ in rows}),
+                sorted({sku for _, (_, sku), _ in rows}),
+            ),
+        )
+        found = {"location": {}, "product": {}}
+        for match in cur.fetchall():
+            found[match["kind"]].setdefault(match["key"], match["id"])
+
+        upserts = []
+        for line, (location_key, sku_key), (location, sku, min_jars) in rows:
+            location_id = found["location"].get(location_key)
+            product_id = found["product"].get(sku_key)
+            if location_id is None:
+                result.error(line, f"No location named '{location}'.")
+            elif product_id is None:
+                result.error(line, f"No product with SKU '{sku}'.")
+            else:
+                upserts.append((location_id, product_id, min_jars))
+
+        if upserts:
+            # xmax is 0 only on a freshly inserted row version.
+            inserted = execute_values(
+                cur,
+                """INSERT INTO stock_minimums (location_id, product_id, min_jars)
+                   VALUES %s
+                   ON CONFLICT (product_id, location_id)
+                   DO UPDATE SET min_jars = EXCLUDED.min_jars
+                   RETURNING (xmax = 0) AS inserted;""",
+                upserts,
+                page_size=len(upserts),
+                fetch=True,
+            )
+            new_rows = sum(1 for row in inserted if row[0])
+            result.inserted += new_rows
+            result.updated += len(upserts) - new_rows
+
+
+IMPORTERS = {
+    "inventory-items": InventoryItemImport(),
+    "products": ProductImport(),
+    "stock-minimums": StockMinimumImport(),
+}
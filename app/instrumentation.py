@@ -0,0 +1,228 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from flask import g, jsonify, request
+
+from app.db import _int_env
+
+logger = logging.getLogger(__name__)
+
+# --- Request-level SQL instrumentation ---
+# Enabled with SQL_INSTRUMENTATION=1. The request connection from get_db()
+# is wrapped so every statement its cursors run is counted and timed; the
+# totals go out in a Server-Timing header and are aggregated per route
+# at /_metrics.
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACES = re.compile(r"\s+")
+
+
+def _enabled():
+    return os.getenv("SQL_INSTRUMENTATION", "").lower() in ("1", "true", "yes", "on")
+
+
+def statement_shape(sql):
+    """
+    SQL with literals replaced by '?' and whitespace collapsed, so the same
+    statement run with different values (or expanded by execute_values)
+    counts as one shape.
+    """
+    if isinstance(sql, bytes):
+        sql = sql.decode("utf-8", "replace")
+    elif not isinstance(sql, str):
+        sql = str(sql)  # psycopg2.sql.Composed
+    return _SPACES.sub(" ", _LITERALS.sub("?", sql)).strip()
+
+
+class RequestStats:
+    """Statements run on the request connection during one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_sql = None
+        self.shapes = Counter()
+
+    def record(self, sql, elapsed):
+        shape = statement_shape(sql)
+        self.count += 1
+        self.total_time += elapsed
+        self.shapes[shape] += 1
+        if elapsed > self.slowest_time:
+            self.slowest_time = elapsed
+            self.slowest_sql = shape
+
+    def repeated(self, threshold):
+        """Statement shapes run at least 'threshold' times (likely N+1)."""
+        return {
+            shape: count
+            for shape, count in self.shapes.most_common()
+            if count >= threshold
+        }
+
+
+class InstrumentedCursor:
+    """Cursor proxy that times execute/executemany/copy_expert."""
+
+    def __init__(self, cursor, stats):
+        object.__setattr__(self, "_cursor", cursor)
+        object.__setattr__(self, "_stats", stats)
+
+    def _timed(self, method, sql, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(sql, *args, **kwargs)
+        finally:
+            self._stats.record(sql, time.perf_counter() - start)
+
+    def execute(self, sql, *args, **kwargs):
+        return self._timed(self._cursor.execute, sql, *args, **kwargs)
+
+    def executemany(self, sql, *args, **kwargs):
+        return self._timed(self._cursor.executemany, sql, *args, **kwargs)
+
+    def copy_expert(self, sql, *args, **kwargs):
+        return self._timed(self._cursor.copy_expert, sql, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)  # e.g. cur.itersize
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._cursor.__exit__(*exc)
+
+
+class InstrumentedConnection:
+    """Connection proxy whose cursors report into 'stats'."""
+
+    def __init__(self, conn, stats):
+        object.__setattr__(self, "_conn", conn)
+        object.__setattr__(self, "stats", stats)
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self.stats)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)  # e.g. conn.autocommit
+
+
+def instrument_connection(conn):
+    """Wraps the request connection; installed as get_db()'s wrapper."""
+    g.sql_stats = RequestStats()
+    return InstrumentedConnection(conn, g.sql_stats)
+
+
+class RouteMetrics:
+    """Per-endpoint totals across requests, for spotting what to optimize."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, endpoint, stats, n_plus_one):
+        with self._lock:
+            route = self._routes.setdefault(
+                endpoint,
+                {
+                    "requests": 0,
+                    "queries": 0,
+                    "max_queries": 0,
+                    "db_time_ms": 0.0,
+                    "slowest_ms": 0.0,
+                    "slowest_statement": None,
+                    "n_plus_one_requests": 0,
+                    "repeated_statements": {},
+                },
+            )
+            route["requests"] += 1
+            route["queries"] += stats.count
+            route["max_queries"] = max(route["max_queries"], stats.count)
+            route["db_time_ms"] += stats.total_time * 1000
+            if stats.slowest_time * 1000 > route["slowest_ms"]:
+                route["slowest_ms"] = stats.slowest_time * 1000
+                route["slowest_statement"] = stats.slowest_sql
+            if n_plus_one:
+                route["n_plus_one_requests"] += 1
+                for shape, count in n_plus_one.items():
+                    seen = route["repeated_statements"].get(shape, 0)
+                    route["repeated_statements"][shape] = max(seen, count)
+
+    def snapshot(self):
+        with self._lock:
+            routes = [
+                {
+                    "endpoint": endpoint,
+                    **data,
+                    "avg_queries": round(data["queries"] / data["requests"], 1),
+                    "avg_db_time_ms": round(data["db_time_ms"] / data["requests"], 2),
+                    "db_time_ms": round(data["db_time_ms"], 2),
+                    "slowest_ms": round(data["slowest_ms"], 2),
+                    "repeated_statements": dict(data["repeated_statements"]),
+                }
+                for endpoint, data in self._routes.items()
+            ]
+        return sorted(routes, key=lambda r: r["db_time_ms"], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+route_metrics = RouteMetrics()
+N_PLUS_ONE_THRESHOLD = _int_env("SQL_N_PLUS_ONE_THRESHOLD", 5)
+
+
+def _report_request(response):
+    stats = g.pop("sql_stats", None)
+    if stats is None:
+        return response
+
+    n_plus_one = stats.repeated(N_PLUS_ONE_THRESHOLD)
+    endpoint = request.endpoint or request.path
+    route_metrics.record(endpoint, stats, n_plus_one)
+    for shape, count in n_plus_one.items():
+        logger.warning("Possible N+1 in %s: %sx %s", endpoint, count, shape[:200])
+
+    response.headers.add(
+        "Server-Timing",
+        f'db;dur={stats.total_time * 1000:.1f};desc="{stats.count} queries"',
+    )
+    return response
+
+
+def metrics_view():
+    return jsonify(
+        {
+            "n_plus_one_threshold": N_PLUS_ONE_THRESHOLD,
+            "routes": route_metrics.snapshot(),
+        }
+    )
+
+
+def init_app(app):
+    """
+    Register the SQL instrumentation with the Flask app, if enabled by the
+    SQL_INSTRUMENTATION environment variable.
+    """
+    if not _enabled():
+        return
+    app.extensions["db_connection_wrapper"] = instrument_connection
+    app.after_request(_report_request)
+    app.add_url_rule("/_metrics", "sql_metrics", metrics_view)
@@ -0,0 +1,560 @@
+import csv
+import io
+from collections import defaultdict
+
+from psycopg2.extras import execute_values
+
+from app.models import _log_inventory_adjustments
+
+# --- Set-based stock movements ---
+# Each helper works on many inventory rows with a constant number of
+# statements, so the transactions that call them hold row locks briefly.
+
+
+def lock_inventory_items(cur, item_ids):
+    """
+    Locks the given inventory rows in id order (a consistent order avoids
+    deadlocks between concurrent writers) and returns them keyed by id.
+    """
+    cur.execute(
+        """SELECT id, name, quantity_on_hand, quantity_allocated,
+                  (quantity_on_hand - quantity_allocated) AS available
+           FROM inventory_items WHERE id = ANY(%s) ORDER BY id FOR UPDATE;""",
+        (sorted(item_ids),),
+    )
+    return {row["id"]: row for row in cur.fetchall()}
+
+
+def allocate_to_batch(cur, batch_id, quantities):
+    """
+    Allocates stock to a WIP batch. 'quantities' maps inventory item id to
+    the quantity to allocate. Every item is checked before anything is
+    written; raises ValueError if an item is missing or short.
+    """
+    items = lock_inventory_items(cur, quantities.keys())
+    for item_id, quantity in sorted(quantities.items()):
+        item = items.get(item_id)
+        if not item:
+            raise ValueError(f"Item ID {item_id} not found.")
+        if item["available"] < quantity:
+            raise ValueError(
+                f"Not enough stock for '{item['name']}'. Available: {item['available']}, Tried to allocate: {quantity}"
+            )
+
+    rows = sorted(quantities.items())
+    execute_values(
+        cur,
+        "INSERT INTO wip_allocations (wip_batch_id, inventory_item_id, quantity_allocated) VALUES %s;",
+        [(batch_id, item_id, quantity) for item_id, quantity in rows],
+    )
+    execute_values(
+        cur,
+        """UPDATE inventory_items AS inv
+           SET quantity_allocated = inv.quantity_allocated + v.quantity
+           FROM (VALUES %s) AS v(id, quantity)
+           WHERE inv.id = v.id;""",
+        rows,
+        template="(%s::int, %s::numeric)",
+    )
+
+
+def _running_totals(final_quantity, changes):
+    """
+    Quantity on hand after each of 'changes' was applied in order, given
+    the quantity after all of them. Used to log the same new_quantity
+    values that applying the changes one at a time would have produced.
+    """
+    quantity = final_quantity - sum(changes)
+    totals = []
+    for change in changes:
+        quantity += change
+        totals.append(quantity)
+    return totals
+
+
+# Takes every allocated quantity of the given batches out of stock with one
+# UPDATE and reports, per batch and item, what was consumed along with the
+# item's resulting quantity on hand.
+_CONSUME_ALLOCATIONS_SQL = """
+    WITH consumed AS (
+        SELECT wip_batch_id, inventory_item_id,
+               SUM(quantity_allocated) AS total_allocated
+        FROM wip_allocations
+        WHERE wip_batch_id = ANY(%s)
+        GROUP BY wip_batch_id, inventory_item_id
+    ),
+    per_item AS (
+        SELECT inventory_item_id, SUM(total_allocated) AS total_allocated
+        FROM consumed
+        GROUP BY inventory_item_id
+    ),
+    updated AS (
+        UPDATE inventory_items AS inv
+        SET quantity_on_hand = inv.quantity_on_hand - p.total_allocated,
+            quantity_allocated = inv.quantity_allocated - p.total_allocated
+        FROM per_item p
+        WHERE inv.id = p.inventory_item_id
+        RETURNING inv.id, inv.quantity_on_hand
+    )
+    SELECT c.wip_batch_id, c.inventory_item_id, c.total_allocated, u.quantity_on_hand
+    FROM consumed c
+    JOIN updated u ON u.id = c.inventory_item_id
+    ORDER BY c.wip_batch_id, c.inventory_item_id;
+"""
+
+
+def complete_wip_batches(cur, yields):
+    """
+    Completes WIP batches in one pass. 'yields' maps batch id to its actual
+    yield. Allocations are consumed with one UPDATE, yields are added to
+    location or ingredient stock with multi-row writes, and every
+    inventory_adjustments row goes in with a single insert.
+    Raises ValueError if any batch cannot be completed; the caller rolls
+    back. Returns a dict per completed batch, in batch id order.
+    """
+    batch_ids = sorted(yields)
+    cur.execute(
+        """SELECT w.*, i.unit AS item_unit FROM wip_batches w
+           LEFT JOIN inventory_items i ON w.inventory_item_id = i.id
+           WHERE w.id = ANY(%s) ORDER BY w.id FOR UPDATE OF w;""",
+        (batch_ids,),
+    )
+    batches = {row["id"]: row for row in cur.fetchall()}
+    for batch_id in batch_ids:
+        batch = batches.get(batch_id)
+        if not batch or batch["status"] != "In Progress":
+            raise ValueError(f"Batch {batch_id} not found or already completed.")
+        if batch["batch_type"] not in ("PRODUCT", "INTERMEDIATE"):
+            raise ValueError(f"Batch {batch_id} has an unknown batch type.")
+
+    # Lock the consumed inventory rows in id order, as allocation does.
+    cur.execute(
+        """SELECT id FROM inventory_items
+           WHERE id IN (
+               SELECT inventory_item_id FROM wip_allocations WHERE wip_batch_id = ANY(%s)
+           )
+           ORDER BY id FOR UPDATE;""",
+        (batch_ids,),
+    )
+    cur.execute(_CONSUME_ALLOCATIONS_SQL, (batch_ids,))
+    consumed = cur.fetchall()
+
+    allocated_batches = {row["wip_batch_id"] for row in consumed}
+    for batch_id in batch_ids:
+        if batch_id not in allocated_batches:
+            raise ValueError(
+                f"Cannot complete batch {batch_id}: No ingredients were allocated."
+            )
+
+    adjustments = []
+    consumed_by_item = defaultdict(list)
+    for row in consumed:
+        consumed_by_item[row["inventory_item_id"]].append(row)
+    for item_id, rows in consumed_by_item.items():
+        changes = [-float(row["total_allocated"]) for row in rows]
+        new_quantities = _running_totals(float(rows[0]["quantity_on_hand"]), changes)
+        for row, change, new_qoh in zip(rows, changes, new_quantities):
+            adjustments.append(
+                {
+                    "inventory_item_id": item_id,
+                    "adjustment_quantity": change,
+                    "new_quantity": new_qoh,
+                    "reason": f"WIP Batch #{row['wip_batch_id']} Completed",
+                    "wip_batch_id": row["wip_batch_id"],
+                }
+            )
+
+    completed = []
+    location_yields = defaultdict(float)
+    item_yields = defaultdict(list)
+    for batch_id in batch_ids:
+        batch = batches[batch_id]
+        actual_yield = yields[batch_id]
+        if batch["batch_type"] == "PRODUCT":
+            location_yields[(batch["product_id"], batch["location_id"])] += actual_yield
+            yield_unit = "jars"
+        else:
+            item_yields[batch["inventory_item_id"]].append((batch_id, actual_yield))
+            yield_unit = batch["item_unit"]
+        completed.append(
+            {
+                "id": batch_id,
+                "batch_type": batch["batch_type"],
+                "actual_yield": actual_yield,
+                "yield_unit": yield_unit,
+            }
+        )
+
+    if location_yields:
+        execute_values(
+            cur,
+            """INSERT INTO location_stock (product_id, location_id, quantity)
+            VALUES %s
+            ON CONFLICT (product_id, location_id)
+            DO UPDATE SET quantity = location_stock.quantity + EXCLUDED.quantity;""",
+            [
+                (product_id, location_id, quantity)
+                for (product_id, location_id), quantity in location_yields.items()
+            ],
+        )
+
+    if item_yields:
+        updated = execute_values(
+            cur,
+            """UPDATE inventory_items AS inv
+               SET quantity_on_hand = inv.quantity_on_hand + v.quantity
+               FROM (VALUES %s) AS v(id, quantity)
+               WHERE inv.id = v.id
+               RETURNING inv.id, inv.quantity_on_hand;""",
+            [
+                (item_id, sum(quantity for _, quantity in batch_yields))
+                for item_id, batch_yields in item_yields.items()
+            ],
+            template="(%s::int, %s::numeric)",
+            fetch=True,
+        )
+        final_quantities = {row[0]: float(row[1]) for row in updated}
+        for item_id, batch_yields in item_yields.items():
+            changes = [quantity for _, quantity in batch_yields]
+            new_quantities = _running_totals(final_quantities.get(item_id, 0), changes)
+            for (batch_id, quantity), new_qoh in zip(batch_yields, new_quantities):
+                adjustments.append(
+                    {
+                        "inventory_item_id": item_id,
+                        "adjustment_quantity": quantity,
+                        "new_quantity": new_qoh,
+                        "reason": f"WIP Batch #{batch_id} Completed (Yield)",
+                        "wip_batch_id": batch_id,
+                    }
+                )
+
+    execute_values(
+        cur,
+        """UPDATE wip_batches AS w
+           SET status = 'Completed', completed_at = NOW(),
+               actual_yield = v.actual_yield, actual_yield_unit = v.yield_unit
+           FROM (VALUES %s) AS v(id, actual_yield, yield_unit)
+           WHERE w.id = v.id;""",
+        [(c["id"], c["actual_yield"], c["yield_unit"]) for c in completed],
+        template="(%s::int, %s::numeric, %s::text)",
+    )
+
+    _log_inventory_adjustments(cur, adjustments)
+    return completed
+
+
+def _apply_po_receipts(cur, lines, reason):
+    """
+    Books receipt quantities for purchase order lines: each line dict has
+    id, purchase_order_id, inventory_item_id and a signed quantity. Stock,
+    quantity_received, the receipts ledger and the inventory log are each
+    written with one multi-row statement. 'reason' is formatted with the
+    line's po_id.
+    """
+    lines = [line for line in lines if line["quantity"]]
+    if not lines:
+        return
+
+    per_item = defaultdict(float)
+    for line in lines:
+        per_item[line["inventory_item_id"]] += float(line["quantity"])
+    lock_inventory_items(cur, per_item.keys())
+    updated = execute_values(
+        cur,
+        """UPDATE inventory_items AS inv
+           SET quantity_on_hand = inv.quantity_on_hand + v.quantity
+           FROM (VALUES %s) AS v(id, quantity)
+           WHERE inv.id = v.id
+           RETURNING inv.id, inv.quantity_on_hand;""",
+        sorted(per_item.items()),
+        template="(%s::int, %s::numeric)",
+        fetch=True,
+    )
+    final_quantities = {row[0]: float(row[1]) for row in updated}
+
+    execute_values(
+        cur,
+        """UPDATE purchase_order_items AS poi
+           SET quantity_received = poi.quantity_received + v.quantity
+           FROM (VALUES %s) AS v(id, quantity)
+           WHERE poi.id = v.id;""",
+        [(line["id"], line["quantity"]) for line in lines],
+        template="(%s::int, %s::numeric)",
+    )
+    execute_values(
+        cur,
+        """INSERT INTO purchase_order_receipts
+           (purchase_order_id, purchase_order_item_id, inventory_item_id, quantity)
+           VALUES %s;""",
+        [
+            (
+                line["purchase_order_id"],
+                line["id"],
+                line["inventory_item_id"],
+                line["quantity"],
+            )
+            for line in lines
+        ],
+    )
+
+    adjustments = []
+    lines_by_item = defaultdict(list)
+    for line in lines:
+        lines_by_item[line["inventory_item_id"]].append(line)
+    for item_id, item_lines in lines_by_item.items():
+        changes = [float(line["quantity"]) for line in item_lines]
+        new_quantities = _running_totals(final_quantities.get(item_id, 0), changes)
+        for line, change, new_qoh in zip(item_lines, changes, new_quantities):
+            adjustments.append(
+                {
+                    "inventory_item_id": item_id,
+                    "adjustment_quantity": change,
+                    "new_quantity": new_qoh,
+                    "reason": reason.format(po_id=line["purchase_order_id"]),
+                    "po_id": line["purchase_order_id"],
+                }
+            )
+    _log_inventory_adjustments(cur, adjustments)
+
+
+def move_po_stock(cur, po_ids, sign, reason):
+    """
+    Receives whatever is still outstanding on every line of the given
+    purchase orders (sign 1), or reverses everything received so far
+    (sign -1). Lines already partly received only move the difference.
+    Returns the lines with the signed quantity moved for each; an empty
+    list means the orders have no lines.
+    """
+    cur.execute(
+        """SELECT id, purchase_order_id, inventory_item_id,
+                  CASE WHEN %(sign)s > 0 THEN quantity_ordered - quantity_received
+                       ELSE -quantity_received END AS quantity
+           FROM purchase_order_items
+           WHERE purchase_order_id = ANY(%(po_ids)s)
+           ORDER BY purchase_order_id, id FOR UPDATE;""",
+        {"po_ids": sorted(po_ids), "sign": sign},
+    )
+    lines = cur.fetchall()
+    _apply_po_receipts(cur, lines, reason)
+    return lines
+
+
+def receive_po_lines(cur, po_id, quantities):
+    """
+    Records a (possibly partial) delivery against one purchase order.
+    'quantities' maps purchase_order_items id to the quantity that arrived.
+    Raises ValueError, before anything is written, for unknown lines or a
+    quantity above what is still outstanding. Marks the order Received once
+    every line is complete; returns True in that case.
+    """
+    cur.execute(
+        "SELECT status FROM purchase_orders WHERE id = %s FOR UPDATE;", (po_id,)
+    )
+    if not cur.fetchone():
+        raise ValueError(f"PO #{po_id} not found.")
+
+    cur.execute(
+        """SELECT poi.id, poi.purchase_order_id, poi.inventory_item_id,
+                  poi.quantity_ordered - poi.quantity_received AS outstanding,
+                  inv.name
+           FROM purchase_order_items poi
+           JOIN inventory_items inv ON inv.id = poi.inventory_item_id
+           WHERE poi.purchase_order_id = %s AND poi.id = ANY(%s)
+           ORDER BY poi.id FOR UPDATE OF poi;""",
+        (po_id, sorted(quantities)),
+    )
+    lines = {row["id"]: row for row in cur.fetchall()}
+    receipts = []
+    for line_id, quantity in sorted(quantities.items()):
+        line = lines.get(line_id)
+        if not line:
+            raise ValueError(f"Line {line_id} is not on PO #{po_id}.")
+        if quantity > line["outstanding"]:
+            raise ValueError(
+                f"Cannot receive {quantity} of '{line['name']}'; only {line['outstanding']} outstanding."
+            )
+        receipts.append(
+            {
+                "id": line_id,
+                "purchase_order_id": po_id,
+                "inventory_item_id": line["inventory_item_id"],
+                "quantity": quantity,
+            }
+        )
+    _apply_po_receipts(cur, receipts, "PO #{po_id} Received (Partial)")
+
+    cur.execute(
+        """UPDATE purchase_orders SET status = 'Received', received_at = NOW()
+           WHERE id = %s AND status <> 'Received'
+             AND NOT EXISTS (
+                 SELECT 1 FROM purchase_order_items
+                 WHERE purchase_order_id = %s AND quantity_received < quantity_ordered
+             )
+           RETURNING id;""",
+        (po_id, po_id),
+    )
+    return cur.fetchone() is not None
+
+
+def receive_purchase_orders(cur, po_ids):
+    """
+    Marks several purchase orders Received and books everything still
+    outstanding on their lines into stock in one pass. Raises ValueError, before anything is written, if an
+    order is missing or already received, or after the stock update if an
+    order has no lines; the caller rolls back.
+    """
+    po_ids = sorted(set(po_ids))
+    cur.execute(
+        "SELECT id, status FROM purchase_orders WHERE id = ANY(%s) ORDER BY id FOR UPDATE;",
+        (po_ids,),
+    )
+    statuses = {row["id"]: row["status"] for row in cur.fetchall()}
+    for po_id in po_ids:
+        if po_id not in statuses:
+            raise ValueError(f"PO #{po_id} not found.")
+        if statuses[po_id] == "Received":
+            raise ValueError(f"PO #{po_id} is already Received.")
+
+    lines = move_po_stock(cur, po_ids, 1, "PO #{po_id} Received")
+    with_lines = {line["purchase_order_id"] for line in lines}
+    empty = [po_id for po_id in po_ids if po_id not in with_lines]
+    if empty:
+        raise ValueError(
+            "Cannot mark empty order as Received: "
+            + ", ".join(f"PO #{po_id}" for po_id in empty)
+        )
+
+    cur.execute(
+        "UPDATE purchase_orders SET status = 'Received', received_at = NOW() WHERE id = ANY(%s);",
+        (po_ids,),
+    )
+
+
+# --- Stock counts ---
+# A count sheet is copied into a temporary staging table, resolved and
+# checked there with set-based statements, and applied with a single
+# statement that writes only the lines differing from location_stock,
+# recording a variance row for each.
+
+_STAGE_STOCK_COUNT_SQL = """
+    UPDATE stock_count_staging s SET location_id = l.id
+    FROM locations l WHERE LOWER(l.name) = LOWER(s.location);
+
+    UPDATE stock_count_staging s SET product_id = p.id
+    FROM products p WHERE LOWER(p.sku) = LOWER(s.sku);
+
+    UPDATE stock_count_staging SET
+        counted = CASE WHEN quantity ~ '^[0-9]{1,9}$' THEN quantity::int END,
+        error = CASE
+            WHEN location IS NULL THEN '''location'' is required.'
+            WHEN sku IS NULL THEN '''sku'' is required.'
+            WHEN quantity IS NULL THEN '''quantity'' is required.'
+            WHEN location_id IS NULL THEN 'No location named ''' || location || '''.'
+            WHEN product_id IS NULL THEN 'No product with SKU ''' || sku || '''.'
+            WHEN quantity !~ '^[0-9]{1,9}$'
+                THEN '''quantity'' must be a whole number, got ''' || quantity || '''.'
+        END;
+
+    UPDATE stock_count_staging s
+    SET error = 'Duplicate of line ' || d.first_line || '.'
+    FROM (
+        SELECT line, MIN(line) OVER (PARTITION BY location_id, product_id) AS first_line
+        FROM stock_count_staging WHERE error IS NULL
+    ) d
+    WHERE s.line = d.line AND d.line > d.first_line;
+"""
+
+_APPLY_STOCK_COUNT_SQL = """
+    WITH changed AS (
+        SELECT s.location_id, s.product_id, s.counted,
+               COALESCE(ls.quantity, 0) AS expected, ls.id AS stock_id
+        FROM stock_count_staging s
+        LEFT JOIN location_stock ls
+          ON ls.location_id = s.location_id AND ls.product_id = s.product_id
+        WHERE s.error IS NULL AND s.counted <> COALESCE(ls.quantity, 0)
+    ),
+    updated AS (
+        UPDATE location_stock AS ls
+        SET quantity = c.counted
+        FROM changed c
+        WHERE ls.id = c.stock_id
+    ),
+    inserted AS (
+        INSERT INTO location_stock (location_id, product_id, quantity)
+        SELECT location_id, product_id, counted FROM changed WHERE stock_id IS NULL
+    )
+    INSERT INTO stock_count_variances
+        (stock_count_id, location_id, product_id, expected_quantity, counted_quantity)
+    SELECT %s, location_id, product_id, expected, counted FROM changed;
+"""
+
+
+def stage_stock_count(cur, records):
+    """
+    Copies count sheet 'records', (line number, {location, sku, quantity})
+    pairs, into a temporary stock_count_staging table that is dropped at
+    the end of the transaction, then resolves names to ids and marks the
+    lines that cannot be applied. Returns [(line, error)] in line order.
+    """
+    cur.execute(
+        """CREATE TEMP TABLE stock_count_staging (
+               line INTEGER PRIMARY KEY,
+               location TEXT,
+               sku TEXT,
+               quantity TEXT,
+               location_id INTEGER,
+               product_id INTEGER,
+               counted INTEGER,
+               error TEXT
+           ) ON COMMIT DROP;"""
+    )
+    # Empty cells are written unquoted, which COPY reads as NULL.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for line, row in records:
+        writer.writerow(
+            (line, row.get("location"), row.get("sku"), row.get("quantity"))
+        )
+    buffer.seek(0)
+    cur.copy_expert(
+        "COPY stock_count_staging (line, location, sku, quantity) FROM STDIN WITH (FORMAT csv);",
+        buffer,
+    )
+    cur.execute(_STAGE_STOCK_COUNT_SQL)
+    cur.execute(
+        "SELECT line, error FROM stock_count_staging WHERE error IS NOT NULL ORDER BY line;"
+    )
+    return [(row[0], row[1]) for row in cur.fetchall()]
+
+
+def record_stock_count(cur, records, notes=None):
+    """
+    Stages a count sheet and applies it as a new stock count. Lines that
+    match location_stock are left alone; the rest overwrite it and get a
+    stock_count_variances row with the quantity that was on record.
+    Returns (stock count id, lines changed, [(line, error)]); the id is
+    None, and nothing is written, if no line of the sheet is usable.
+    """
+    errors = stage_stock_count(cur, records)
+    cur.execute("SELECT COUNT(*) FROM stock_count_staging WHERE error IS NULL;")
+    lines_counted = cur.fetchone()[0]
+    if not lines_counted:
+        return None, 0, errors
+
+    cur.execute(
+        """INSERT INTO stock_counts (notes, lines_counted, lines_skipped)
+           VALUES (%s, %s, %s) RETURNING id;""",
+        (notes, lines_counted, len(errors)),
+    )
+    count_id = cur.fetchone()[0]
+    # Lock the counted rows in id order, so the quantities read as
+    # 'expected' cannot change before they are overwritten.
+    cur.execute(
+        """SELECT ls.id FROM location_stock ls
+           JOIN stock_count_staging s
+             ON s.location_id = ls.location_id AND s.product_id = ls.product_id
+           WHERE s.error IS NULL
+           ORDER BY ls.id FOR UPDATE OF ls;"""
+    )
+    cur.execute(_APPLY_STOCK_COUNT_SQL, (count_id,))
+    return count_id, cur.rowcount, errors
@@ -0,0 +1,249 @@
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from flask import request, url_for
+from psycopg2.extras import RealDictCursor
+
+# --- Paged, sortable, searchable list queries ---
+# A ListQuery wraps a route's SELECT as a subquery and adds, from the
+# query string: a name search (?q=), a whitelisted sort (?sort=, ?dir=)
+# and keyset pagination (?after= / ?before=). Only one page is fetched,
+# and the total is the planner's row estimate rather than a COUNT(*).
+
+LIST_PAGE_SIZE = 50
+# Search terms shorter than this are matched as a prefix; longer ones
+# anywhere in the text (served by the pg_trgm indexes).
+TRIGRAM_MIN_LENGTH = 3
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Cannot encode {type(value).__name__} in a page marker")
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, default=_json_default, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(value, length):
+    """Raises ValueError if the marker is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+        values = json.loads(raw)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError("Invalid page marker") from e
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Invalid page marker")
+    return values
+
+
+def _like_pattern(term):
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    if len(term) < TRIGRAM_MIN_LENGTH:
+        return escaped + "%"
+    return "%" + escaped + "%"
+
+
+def _keyset_clause(columns, values):
+    """
+    WHERE clause selecting the rows after 'values' in the given order;
+    columns is a list of (expression, descending). When every column runs
+    the same way this is a single row comparison, which an index on those
+    columns can serve as a range scan; mixed directions are spelled out as
+    ORs so each column can have its own.
+    """
+    directions = {descending for _, descending in columns}
+    if len(directions) == 1:
+        exprs = ", ".join(expr for expr, _ in columns)
+        placeholders = ", ".join(["%s"] * len(columns))
+        op = "<" if directions.pop() else ">"
+        return f"({exprs}) {op} ({placeholders})", list(values)
+
+    alternatives = []
+    params = []
+    for i, (expr, descending) in enumerate(columns):
+        terms = [f"{prev_expr} = %s" for prev_expr, _ in columns[:i]]
+        terms.append(f"{expr} {'<' if descending else '>'} %s")
+        alternatives.append("(" + " AND ".join(terms) + ")")
+        params.extend(values[: i + 1])
+    return "(" + " OR ".join(alternatives) + ")", params
+
+
+class ListPage:
+    """One page of a list, plus what the template needs to link around it."""
+
+    def __init__(
+        self, rows, sort, descending, q, next_cursor, prev_cursor, total, exact
+    ):
+        self.rows = rows
+        self.sort = sort
+        self.descending = descending
+        self.q = q
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+        self.total_is_exact = exact
+        self.endpoint = request.endpoint
+        self.view_args = dict(request.view_args or {})
+
+    def url(self, **changes):
+        args = {
+            "q": self.q,
+            "sort": self.sort,
+            "dir": "desc" if self.descending else "asc",
+        }
+        args.update(changes)
+        args = {key: value for key, value in args.items() if value not in (None, "")}
+        return url_for(self.endpoint, **self.view_args, **args)
+
+    def base_url(self):
+        """The route's URL with no query string, e.g. for a GET form's action."""
+        return url_for(self.endpoint, **self.view_args)
+
+    def sort_url(self, sort):
+        """Link for a column header: toggles direction on the current sort."""
+        descending = not self.descending if sort == self.sort else False
+        return self.url(sort=sort, dir="desc" if descending else "asc")
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class ListQuery:
+    """
+    'base_sql' is a SELECT whose output columns the sorts and searches
+    refer to. 'sorts' maps a ?sort= key to its ORDER BY, a list of
+    (expression, descending) pairs; every list should end with a unique
+    column (the id) so keyset pagination is stable. ?dir=desc reverses
+    the first column's direction and every other column with it.
+    """
+
+    def __init__(
+        self, base_sql, sorts, default_sort, search=(), page_size=LIST_PAGE_SIZE
+    ):
+        self.base_sql = base_sql
+        self.sorts = sorts
+        self.default_sort = default_sort
+        self.search = search
+        self.page_size = page_size
+
+    def empty(self):
+        """A page with no rows, for templates to render when a fetch fails."""
+        descending = self.sorts[self.default_sort][0][1]
+        return ListPage([], self.default_sort, descending, "", None, None, 0, True)
+
+    def _order(self, sort, descending):
+        columns = self.sorts[sort]
+        flip = descending != columns[0][1]
+        return [(expr, desc != flip) for expr, desc in columns]
+
+    def fetch(self, conn, params=()):
+        """
+        Fetches the page the current request's query string asks for.
+        Returns (ListPage, error message or None); an invalid sort or page
+        marker falls back to the first page in the default order.
+        """
+        args = request.args
+        error = None
+        sort = args.get("sort", self.default_sort)
+        if sort not in self.sorts:
+            sort = self.default_sort
+        descending = args.get("dir", "")
+        if descending not in ("asc", "desc"):
+            descending = self.sorts[sort][0][1]
+        else:
+            descending = descending == "desc"
+        q = args.get("q", "").strip()
+        columns = self._order(sort, descending)
+
+        filters, filter_params = [], []
+        if q and self.search:
+            pattern = _like_pattern(q)
+            filters.append(
+                "(" + " OR ".join(f"{expr} ILIKE %s" for expr in self.search) + ")"
+            )
+            filter_params.extend([pattern] * len(self.search))
+
+        after, before = args.get("after"), args.get("before")
+        page_filters, page_params = list(filters), list(filter_params)
+        try:
+            if after:
+                clause, values = _keyset_clause(
+                    columns, decode_cursor(after, len(columns))
+                )
+                page_filters.append(clause)
+                page_params.extend(values)
+            elif before:
+                columns_back = [(expr, not desc) for expr, desc in columns]
+                clause, values = _keyset_clause(
+                    columns_back, decode_cursor(before, len(columns))
+                )
+                page_filters.append(clause)
+                page_params.extend(values)
+        except ValueError:
+            error = "Invalid page marker; showing the first page."
+            after = before = None
+            page_filters, page_params = list(filters), list(filter_params)
+
+        order = [(expr, desc != bool(before)) for expr, desc in columns]
+        sort_keys = ", ".join(
+            f"{expr} AS _sort_{i}" for i, (expr, _) in enumerate(columns)
+        )
+        sql = f"SELECT listing.*, {sort_keys} FROM ({self.base_sql}) AS listing"
+        if page_filters:
+            sql += " WHERE " + " AND ".join(page_filters)
+        sql += " ORDER BY " + ", ".join(
+            f"{expr} {'DESC' if desc else 'ASC'}" for expr, desc in order
+        )
+        sql += " LIMIT %s"
+
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(sql, tuple(params) + tuple(page_params) + (self.page_size + 1,))
+            rows = cur.fetchall()
+
+            has_more = len(rows) > self.page_size
+            rows = rows[: self.page_size]
+            if before:
+                rows.reverse()
+
+            exact = not (after or before or has_more)
+            if exact:
+                total = len(rows)
+            else:
+                total = self._estimate(
+                    cur, filters, tuple(params) + tuple(filter_params)
+                )
+
+        keys = [[row.pop(f"_sort_{i}") for i in range(len(columns))] for row in rows]
+        next_cursor = prev_cursor = None
+        if rows:
+            if has_more or before:
+                next_cursor = encode_cursor(keys[-1])
+            if after or (before and has_more):
+                prev_cursor = encode_cursor(keys[0])
+
+        page = ListPage(
+            rows, sort, descending, q, next_cursor, prev_cursor, total, exact
+        )
+        return page, error
+
+    def _estimate(self, cur, filters, params):
+        """The planner's estimate of the matching rows; no table scan."""
+        sql = f"SELECT 1 FROM ({self.base_sql}) AS listing"
+        if filters:
+            sql += " WHERE " + " AND ".join(filters)
+        cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cur.fetchone()
+        plan = plan["QUERY PLAN"] if isinstance(plan, dict) else plan[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+from app.db import _int_env
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlightMemo:
+    """
+    Memoizes computed values by (key, version), where 'version' is the
+    data_versions stamp of the data the value is computed from. Identical
+    requests that arrive while a value is being computed wait for that one
+    computation instead of starting their own (single-flight). Entries
+    also expire after 'ttl' seconds so unused values do not linger.
+    """
+
+    def __init__(self, maxsize=256, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, version, compute):
+        cache_key = (key, version)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+                self._entries.move_to_end(cache_key)
+                return entry[0]
+            flight = self._flights.get(cache_key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[cache_key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = compute()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[cache_key]
+                if flight.error is None:
+                    self._entries[cache_key] = (flight.result, time.monotonic())
+                    self._entries.move_to_end(cache_key)
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+            flight.done.set()
+        return flight.result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+planner_memo = SingleFlightMemo(
+    maxsize=_int_env("PLANNER_CACHE_SIZE", 256),
+    ttl=_int_env("PLANNER_CACHE_TTL_SECONDS", 600),
+)
+
+# Autocomplete results are small and asked for on every keystroke.
+autocomplete_memo = SingleFlightMemo(
+    maxsize=_int_env("AUTOCOMPLETE_CACHE_SIZE", 1024),
+    ttl=_int_env("AUTOCOMPLETE_CACHE_TTL_SECONDS", 60),
+)
@@ -0,0 +1,127 @@
+import bisect
+import threading
+
+from flask import Response
+
+# --- Prometheus text-format metrics ---
+# A small in-process registry served at /metrics in the text exposition
+# format (version 0.0.4). Values are per worker process, like the pool
+# they describe.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        # The family is named like its one sample, so HELP/TYPE match it.
+        self.name = name + "_total"
+        self.help = help_text
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def samples(self):
+        yield self.name, {}, self._value
+
+
+class Histogram:
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield self.name + "_bucket", {"le": _format_value(bound)}, cumulative
+        yield self.name + "_sum", {}, total
+        yield self.name + "_count", {}, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text):
+        metric = Counter(name, help_text)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, **kwargs):
+        metric = Histogram(name, help_text, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def register_gauges(self, collect):
+        """
+        Adds gauges read at scrape time: 'collect' returns
+        {name: (help, value)}; names whose value is None are skipped.
+        """
+        self._collectors.append(collect)
+
+    def exposition(self):
+        lines = []
+        for collect in self._collectors:
+            for name, (help_text, value) in collect().items():
+                if value is None:
+                    continue
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_format_value(value)}")
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def metrics_view():
+    return Response(registry.exposition(), content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    """
+    Serve the metrics registry at /metrics.
+    """
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -0,0 +1,39 @@
+-- Fully expanded, yield-scaled raw-material quantities for one batch of
+-- each recipe. Maintained by app.models.refresh_recipe_base_ingredients
+-- whenever a recipe's ingredients change.
+CREATE TABLE IF NOT EXISTS recipe_base_ingredients (
+    recipe_id INTEGER NOT NULL REFERENCES recipes (id) ON DELETE CASCADE,
+    inventory_item_id INTEGER NOT NULL REFERENCES inventory_items (id) ON DELETE CASCADE,
+    quantity NUMERIC NOT NULL,
+    PRIMARY KEY (recipe_id, inventory_item_id)
+);
+
+CREATE INDEX IF NOT EXISTS recipe_base_ingredients_item_idx
+    ON recipe_base_ingredients (inventory_item_id);
+
+-- Backfill every existing recipe.
+DELETE FROM recipe_base_ingredients;
+
+WITH RECURSIVE tree (root_id, recipe_id, factor, path) AS (
+    SELECT r.id, r.id, 1::numeric, ARRAY[r.id]
+    FROM recipes r
+    UNION ALL
+    SELECT t.root_id, i.sub_recipe_id,
+           (t.factor * CASE
+               WHEN sr.yield_unit IN ('grams', 'mLs') AND sr.yield_quantity <> 0
+                   THEN i.quantity::numeric / sr.yield_quantity::numeric
+               WHEN sr.yield_unit = 'batches' THEN i.quantity::numeric
+               ELSE 1
+           END)::numeric,
+           t.path || i.sub_recipe_id
+    FROM tree t
+    JOIN ingredients i ON i.recipe_id = t.recipe_id
+    JOIN recipes sr ON sr.id = i.sub_recipe_id
+    WHERE NOT i.sub_recipe_id = ANY (t.path)
+)
+INSERT INTO recipe_base_ingredients (recipe_id, inventory_item_id, quantity)
+SELECT t.root_id, i.inventory_item_id, SUM(t.factor * i.quantity::numeric)
+FROM tree t
+JOIN ingredients i ON i.recipe_id = t.recipe_id
+JOIN inventory_items inv ON inv.id = i.inventory_item_id
+GROUP BY t.root_id, i.inventory_item_id;
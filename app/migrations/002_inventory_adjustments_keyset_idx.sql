@@ -0,0 +1,7 @@
+-- Supports keyset pagination of the inventory log, newest first, both
+-- unfiltered and filtered to a single inventory item.
+CREATE INDEX IF NOT EXISTS inventory_adjustments_created_id_idx
+    ON inventory_adjustments (created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS inventory_adjustments_item_created_id_idx
+    ON inventory_adjustments (inventory_item_id, created_at DESC, id DESC);
@@ -0,0 +1,24 @@
+-- Per-line receiving for purchase orders: how much of each line has
+-- arrived, plus a ledger of every receipt (negative rows are reversals).
+ALTER TABLE purchase_order_items
+    ADD COLUMN IF NOT EXISTS quantity_received NUMERIC NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS purchase_order_receipts (
+    id SERIAL PRIMARY KEY,
+    purchase_order_id INTEGER NOT NULL REFERENCES purchase_orders (id) ON DELETE CASCADE,
+    purchase_order_item_id INTEGER REFERENCES purchase_order_items (id) ON DELETE SET NULL,
+    inventory_item_id INTEGER NOT NULL REFERENCES inventory_items (id) ON DELETE CASCADE,
+    quantity NUMERIC NOT NULL,
+    received_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS purchase_order_receipts_po_idx
+    ON purchase_order_receipts (purchase_order_id, received_at);
+
+-- Orders received before this migration were received in full.
+UPDATE purchase_order_items poi
+SET quantity_received = poi.quantity_ordered
+FROM purchase_orders po
+WHERE po.id = poi.purchase_order_id
+  AND (po.status = 'Received' OR po.received_at IS NOT NULL)
+  AND poi.quantity_received = 0;
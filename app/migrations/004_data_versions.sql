@@ -0,0 +1,14 @@
+-- Per-domain data version stamps. Writes bump the domains they touch in
+-- the same transaction; read pages derive ETags from them and server-side
+-- caches use them as keys.
+CREATE TABLE IF NOT EXISTS data_versions (
+    domain TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+INSERT INTO data_versions (domain)
+VALUES ('inventory'), ('recipes'), ('products'), ('stock_minimums'),
+       ('location_stock'), ('purchase_orders'), ('wip'), ('suppliers'),
+       ('locations')
+ON CONFLICT (domain) DO NOTHING;
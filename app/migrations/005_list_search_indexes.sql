@@ -0,0 +1,31 @@
+-- Indexes behind the paged list pages (app/listing.py): trigram indexes
+-- for name/SKU search and (sort key, id) indexes for keyset pagination.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS inventory_items_name_trgm_idx
+    ON inventory_items USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS products_product_name_trgm_idx
+    ON products USING gin (product_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS products_sku_trgm_idx
+    ON products USING gin (sku gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS suppliers_name_trgm_idx
+    ON suppliers USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS locations_name_trgm_idx
+    ON locations USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS recipes_name_trgm_idx
+    ON recipes USING gin (name gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS inventory_items_lower_name_idx
+    ON inventory_items (LOWER(name), id);
+CREATE INDEX IF NOT EXISTS products_lower_product_name_idx
+    ON products (COALESCE(LOWER(product_name), ''), id);
+CREATE INDEX IF NOT EXISTS products_lower_sku_idx
+    ON products (LOWER(sku), id);
+CREATE INDEX IF NOT EXISTS suppliers_lower_name_idx
+    ON suppliers (LOWER(name), id);
+CREATE INDEX IF NOT EXISTS locations_lower_name_idx
+    ON locations (LOWER(name), id);
+CREATE INDEX IF NOT EXISTS purchase_orders_status_date_idx
+    ON purchase_orders (status, order_date DESC, id DESC);
+CREATE INDEX IF NOT EXISTS purchase_orders_order_date_idx
+    ON purchase_orders (order_date DESC, id DESC);
@@ -0,0 +1,22 @@
+-- Physical stock counts of finished products at fulfillment locations.
+-- Each count records only the lines whose counted quantity differed from
+-- location_stock, with the quantity that was on record at the time.
+CREATE TABLE IF NOT EXISTS stock_counts (
+    id SERIAL PRIMARY KEY,
+    counted_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    notes TEXT,
+    lines_counted INTEGER NOT NULL DEFAULT 0,
+    lines_skipped INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS stock_count_variances (
+    id SERIAL PRIMARY KEY,
+    stock_count_id INTEGER NOT NULL REFERENCES stock_counts (id) ON DELETE CASCADE,
+    location_id INTEGER NOT NULL REFERENCES locations (id) ON DELETE CASCADE,
+    product_id INTEGER NOT NULL REFERENCES products (id) ON DELETE CASCADE,
+    expected_quantity INTEGER NOT NULL,
+    counted_quantity INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS stock_count_variances_count_idx
+    ON stock_count_variances (stock_count_id);
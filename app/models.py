@@ -1,77 +1,214 @@
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
 from collections import defaultdict
 import math
 
-# --- RECURSIVE LOGIC (Refactored with request-local cache) ---
+# --- MATERIALIZED BOM (recipe_base_ingredients) ---
 
+_ANCESTOR_RECIPES_SQL = """
+    WITH RECURSIVE ancestors(recipe_id) AS (
+        SELECT unnest(%s::int[])
+        UNION
+        SELECT i.recipe_id
+        FROM ingredients i
+        JOIN ancestors a ON i.sub_recipe_id = a.recipe_id
+    )
+    SELECT recipe_id FROM ancestors;
+"""
 
-def get_base_ingredients(recipe_id, conn, cache=None):
+# A sub-recipe line consumes quantity / yield batches of the sub-recipe
+# when it yields grams or mLs, 'quantity' batches when it yields batches,
+# and one batch otherwise. The 'path' array stops the walk if the recipe
+# graph contains a cycle.
+_MATERIALIZE_BOM_SQL = """
+    WITH RECURSIVE tree(root_id, recipe_id, factor, path) AS (
+        SELECT r.id, r.id, 1::numeric, ARRAY[r.id]
+        FROM recipes r
+        WHERE r.id = ANY(%s)
+        UNION ALL
+        SELECT t.root_id, i.sub_recipe_id,
+               (t.factor * CASE
+                   WHEN sr.yield_unit IN ('grams', 'mLs') AND sr.yield_quantity <> 0
+                       THEN i.quantity::numeric / sr.yield_quantity::numeric
+                   WHEN sr.yield_unit = 'batches' THEN i.quantity::numeric
+                   ELSE 1
+               END)::numeric,
+               t.path || i.sub_recipe_id
+        FROM tree t
+        JOIN ingredients i ON i.recipe_id = t.recipe_id
+        JOIN recipes sr ON sr.id = i.sub_recipe_id
+        WHERE NOT i.sub_recipe_id = ANY(t.path)
+    )
+    INSERT INTO recipe_base_ingredients (recipe_id, inventory_item_id, quantity)
+    SELECT t.root_id, i.inventory_item_id, SUM(t.factor * i.quantity::numeric)
+    FROM tree t
+    JOIN ingredients i ON i.recipe_id = t.recipe_id
+    JOIN inventory_items inv ON inv.id = i.inventory_item_id
+    GROUP BY t.root_id, i.inventory_item_id;
+"""
+
+
+def refresh_recipe_base_ingredients(cur, recipe_ids):
     """
-    Recursively finds all base ingredients for a given recipe.
-    A 'cache' dict must be passed in to prevent re-calculation
-    during a single request.
+    Rebuilds the materialized BOM rows for the given recipes and every
+    recipe that uses them, directly or through other sub-recipes.
+    Must run inside the transaction that changed the recipes.
     """
-    if cache is None:
-        cache = {}  # Initialize cache if this is the first call
+    cur.execute(_ANCESTOR_RECIPES_SQL, (list(recipe_ids),))
+    affected_ids = [row[0] for row in cur.fetchall()]
+    cur.execute(
+        "DELETE FROM recipe_base_ingredients WHERE recipe_id = ANY(%s);",
+        (affected_ids,),
+    )
+    cur.execute(_MATERIALIZE_BOM_SQL, (affected_ids,))
+
 
-    if recipe_id in cache:
-        return [ing.copy() for ing in cache[recipe_id]]
+_REQUIREMENTS_REPORT_SQL = """
+    WITH product_needs AS (
+        SELECT p.recipe_id, p.jars_per_batch,
+               sm.total_min * %(multiplier)s::numeric
+                   - COALESCE(ls.total_stock, 0) AS jars_to_produce
+        FROM (
+            SELECT product_id, SUM(min_jars) AS total_min
+            FROM stock_minimums GROUP BY product_id
+        ) sm
+        JOIN products p ON p.id = sm.product_id
+        LEFT JOIN (
+            SELECT product_id, SUM(quantity) AS total_stock
+            FROM location_stock GROUP BY product_id
+        ) ls ON ls.product_id = sm.product_id
+        WHERE p.jars_per_batch IS NOT NULL AND p.jars_per_batch > 0
+    ),
+    batches AS (
+        SELECT recipe_id,
+               CEIL(jars_to_produce / jars_per_batch::numeric) AS batches_needed
+        FROM product_needs
+        WHERE jars_to_produce > 0
+    ),
+    needs AS (
+        SELECT rbi.inventory_item_id,
+               SUM(rbi.quantity * b.batches_needed) AS total_needed
+        FROM batches b
+        JOIN recipe_base_ingredients rbi ON rbi.recipe_id = b.recipe_id
+        GROUP BY rbi.inventory_item_id
+    ),
+    report AS (
+        SELECT TRIM(inv.name) AS name, TRIM(inv.unit) AS unit,
+               n.total_needed::numeric AS total_needed,
+               inv.quantity_on_hand::numeric AS on_hand,
+               inv.quantity_allocated::numeric AS allocated,
+               (inv.quantity_on_hand - inv.quantity_allocated)::numeric AS available
+        FROM needs n
+        JOIN inventory_items inv ON inv.id = n.inventory_item_id
+    )
+    SELECT name, unit,
+           ROUND(total_needed, 2) AS total_needed,
+           ROUND(on_hand, 2) AS on_hand,
+           ROUND(allocated, 2) AS allocated,
+           ROUND(available, 2) AS available,
+           ROUND(total_needed - available, 2) AS net_needed
+    FROM report
+    WHERE total_needed > available
+    ORDER BY name;
+"""
 
+
+def get_requirements_report(conn, multiplier=1):
+    """
+    Computes the net raw-ingredient requirements needed to bring every
+    product up to its stock minimums (scaled by 'multiplier'), less the
+    finished stock already at locations. The whole report, including the
+    batch rounding and the net-needed comparison, runs as one statement.
+    """
+    with conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute(_REQUIREMENTS_REPORT_SQL, {"multiplier": multiplier})
+        return [
+            {
+                "name": row["name"],
+                "unit": row["unit"],
+                "total_needed": float(row["total_needed"]),
+                "on_hand": float(row["on_hand"]),
+                "allocated": float(row["allocated"]),
+                "available": float(row["available"]),
+                "net_needed": float(row["net_needed"]),
+            }
+            for row in cur.fetchall()
+        ]
+
+
+# --- RECIPE DASHBOARD ---
+_DASHBOARD_INGREDIENTS_SQL = """
+    SELECT i.recipe_id, i.quantity, i.sub_recipe_id,
+           COALESCE(inv.name, r_sub.name, i.name, 'Unknown') AS name,
+           COALESCE(inv.unit, i.unit, 'N/A') AS unit
+    FROM ingredients i
+    LEFT JOIN inventory_items inv ON i.inventory_item_id = inv.id
+    LEFT JOIN recipes r_sub ON i.sub_recipe_id = r_sub.id
+    WHERE i.recipe_id = ANY(%s)
+    ORDER BY i.recipe_id, i.id;
+"""
+
+# Gram/mL totals of each recipe's fully expanded base ingredients.
+_DASHBOARD_TOTALS_SQL = """
+    SELECT rbi.recipe_id,
+           COALESCE(SUM(rbi.quantity) FILTER (WHERE LOWER(inv.unit) = 'grams'), 0)
+               AS grams,
+           COALESCE(SUM(rbi.quantity) FILTER (WHERE LOWER(inv.unit) = 'mls'), 0)
+               AS mls
+    FROM recipe_base_ingredients rbi
+    JOIN inventory_items inv ON inv.id = rbi.inventory_item_id
+    WHERE rbi.recipe_id = ANY(%s)
+    GROUP BY rbi.recipe_id;
+"""
+
+
+def get_recipe_dashboard(conn, search="", page=1, page_size=30):
+    """
+    One page of recipes (optionally filtered by name) with their direct
+    ingredient lines and gram/mL totals, in three queries however many
+    recipes are shown. Returns (recipes, total matching recipes).
+    """
     with conn.cursor(cursor_factory=DictCursor) as cur:
         cur.execute(
-            """
-            SELECT i.*, inv.id as inventory_item_id, inv.name as inv_name, inv.unit as inv_unit
-            FROM ingredients i LEFT JOIN inventory_items inv ON i.inventory_item_id = inv.id
-            WHERE i.recipe_id = %s; """,
-            (recipe_id,),
+            """SELECT r.*, COUNT(*) OVER () AS total_count
+               FROM recipes r
+               WHERE r.name ILIKE %s
+               ORDER BY r.name, r.id
+               LIMIT %s OFFSET %s;""",
+            (
+                "%"
+                + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                + "%",
+                page_size,
+                (page - 1) * page_size,
+            ),
         )
-        ingredients = cur.fetchall()
-        base_ingredients = []
-
-        for ing in ingredients:
-            if ing["sub_recipe_id"]:
-                # --- THIS IS THE UPDATED LOGIC ---
-                cur.execute(
-                    "SELECT yield_quantity, yield_unit FROM recipes WHERE id = %s;",
-                    (ing["sub_recipe_id"],),
-                )
-                sub_recipe_yield_row = cur.fetchone()
-
-                scaling_ratio = 1.0
-                if sub_recipe_yield_row:
-                    yield_qty = sub_recipe_yield_row.get("yield_quantity")
-                    yield_unit = sub_recipe_yield_row.get("yield_unit")
-
-                    if yield_unit in ("grams", "mLs"):
-                        if yield_qty and float(yield_qty) != 0:
-                            scaling_ratio = float(ing["quantity"]) / float(yield_qty)
-                    elif yield_unit == "batches":
-                        scaling_ratio = float(ing["quantity"])
-
-                # --- Pass the cache during recursion ---
-                sub_ingredients = get_base_ingredients(
-                    ing["sub_recipe_id"], conn, cache
-                )
-
-                for sub_ing in sub_ingredients:
-                    scaled_ing = dict(sub_ing)
-                    scaled_ing["quantity"] = (
-                        float(scaled_ing.get("quantity", 0)) * scaling_ratio
-                    )
-                    base_ingredients.append(scaled_ing)
-
-            elif ing["inventory_item_id"]:
-                raw_ing = {
-                    "inventory_item_id": ing["inventory_item_id"],
-                    "name": ing["inv_name"],
-                    "unit": ing["inv_unit"],
-                    "quantity": float(ing.get("quantity", 0)),
-                }
-                base_ingredients.append(raw_ing)
-
-    cache[recipe_id] = [ing.copy() for ing in base_ingredients]
-    return base_ingredients
+        rows = cur.fetchall()
+        total = rows[0]["total_count"] if rows else 0
+        recipe_ids = [row["id"] for row in rows]
+
+        ingredients = defaultdict(list)
+        totals = {}
+        if recipe_ids:
+            cur.execute(_DASHBOARD_INGREDIENTS_SQL, (recipe_ids,))
+            for line in cur.fetchall():
+                line = dict(line)
+                ingredients[line.pop("recipe_id")].append(line)
+            cur.execute(_DASHBOARD_TOTALS_SQL, (recipe_ids,))
+            totals = {row["recipe_id"]: row for row in cur.fetchall()}
+
+    recipes = []
+    for row in rows:
+        recipe = dict(row)
+        del recipe["total_count"]
+        recipe["ingredients"] = ingredients[recipe["id"]]
+        recipe_totals = totals.get(recipe["id"])
+        recipe["totals"] = {
+            "grams": round(float(recipe_totals["grams"]), 2) if recipe_totals else 0,
+            "mLs": round(float(recipe_totals["mls"]), 2) if recipe_totals else 0,
+        }
+        recipes.append(recipe)
+    return recipes, total
 
 
 # --- HELPER FUNCTION ---
@@ -104,3 +241,31 @@ def _log_inventory_adjustment(
         )
     except Exception as e:
         print(f"CRITICAL: Failed to log inventory adjustment: {e}")
+
+
+def _log_inventory_adjustments(cur, adjustments):
+    """
+    Bulk version of _log_inventory_adjustment: inserts many log rows with
+    one statement. Each adjustment is a dict with inventory_item_id,
+    adjustment_quantity, new_quantity, reason and optionally po_id and
+    wip_batch_id. Assumes inventory_items has *already* been updated.
+    """
+    if not adjustments:
+        return
+    execute_values(
+        cur,
+        """INSERT INTO inventory_adjustments
+        (inventory_item_id, adjustment_quantity, new_quantity, reason, purchase_order_id, wip_batch_id)
+        VALUES %s;""",
+        [
+            (
+                adj["inventory_item_id"],
+                adj["adjustment_quantity"],
+                adj["new_quantity"],
+                adj["reason"],
+                adj.get("po_id"),
+                adj.get("wip_batch_id"),
+            )
+            for adj in adjustments
+        ],
+    )
@@ -4,92 +4,75 @@ from flask import (
     Blueprint,
     flash,
     g,
+    jsonify,
     redirect,
     render_template,
     request,
     url_for,
     session,
 )
-from collections import defaultdict
 import math
 from datetime import datetime
 
-from app.db import get_db
-from app.models import get_base_ingredients
+from app.dashboard import compute_dashboard_data, dashboard_snapshot
+from app.db import get_db, release_db
+from app.aggregation import (
+    BomMatrix,
+    compare_scenarios,
+    load_sellable_products,
+    max_producible,
+    shortage_impact,
+)
+from app.memo import planner_memo
+from app.models import get_requirements_report
+from app.versions import versioned, versions_key
 
 bp = Blueprint("core", __name__)
 
+# Forecast horizons (in months) offered on the requirements pages.
+FORECAST_MONTHS = [1, 2, 3, 6]
+MAX_CUSTOM_SCENARIOS = 4
+
+# Data the requirements-style reports are computed from.
+REPORT_DOMAINS = (
+    "inventory",
+    "recipes",
+    "products",
+    "stock_minimums",
+    "location_stock",
+    "wip",
+)
+# Data the production planner is computed from.
+PLANNER_DOMAINS = ("inventory", "recipes", "products")
 
-@bp.route("/")
-def home():
-    conn = get_db()
-    dashboard_data = {"wip_batches_count": 0, "open_pos_count": 0, "low_stock_count": 0}
-    try:
-        all_base_ingredients = []
-        inventory_levels = {}
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(
-                "SELECT COUNT(id) as count FROM wip_batches WHERE status = 'In Progress';"
-            )
-            dashboard_data["wip_batches_count"] = cur.fetchone()["count"]
-            cur.execute(
-                "SELECT COUNT(id) as count FROM purchase_orders WHERE status = 'Placed' OR status = 'Shipped';"
-            )
-            dashboard_data["open_pos_count"] = cur.fetchone()["count"]
-            cur.execute(
-                "SELECT id, name, unit, quantity_on_hand, quantity_allocated FROM inventory_items;"
-            )
-            for item in cur.fetchall():
-                inventory_levels[item["id"]] = {
-                    "available": float(item.get("quantity_on_hand", 0))
-                    - float(item.get("quantity_allocated", 0))
-                }
-            cur.execute(
-                """
-                SELECT p.recipe_id, p.jars_per_batch, SUM(sm.min_jars) as total_jars
-                FROM stock_minimums sm
-                JOIN products p ON sm.product_id = p.id
-                JOIN recipes r ON p.recipe_id = r.id
-                WHERE r.is_sold_product = TRUE AND p.jars_per_batch IS NOT NULL AND p.jars_per_batch > 0
-                GROUP BY p.recipe_id, p.jars_per_batch;
-            """
-            )
-            products_to_make = cur.fetchall()
 
-            recipe_cache = {}
+def _forecast_months():
+    return session.get("forecast_months", 1)
 
-            for prod in products_to_make:
-                batches_needed = math.ceil(
-                    float(prod["total_jars"]) / float(prod["jars_per_batch"])
-                )
-                base_ingredients_one_batch = get_base_ingredients(
-                    prod["recipe_id"], conn, recipe_cache
-                )
-                for ing in base_ingredients_one_batch:
-                    scaled_ing = dict(ing)
-                    scaled_ing["quantity"] = (
-                        float(scaled_ing["quantity"]) * batches_needed
-                    )
-                    all_base_ingredients.append(scaled_ing)
-            totals_needed = defaultdict(lambda: {"total_needed": 0})
-            for ing in all_base_ingredients:
-                inv_item_id = ing.get("inventory_item_id")
-                if inv_item_id:
-                    totals_needed[inv_item_id]["total_needed"] += float(
-                        ing.get("quantity", 0)
-                    )
-            low_stock_count = 0
-            for inv_id, needed_data in totals_needed.items():
-                available = inventory_levels.get(inv_id, {"available": 0})["available"]
-                net_needed = needed_data["total_needed"] - available
-                if net_needed > 0:
-                    low_stock_count += 1
-            dashboard_data["low_stock_count"] = low_stock_count
-    except psycopg2.Error as e:
-        flash(f"Error fetching dashboard data: {e}", "error")
-        print(f"DB Error fetching dashboard data: {e}")
 
-    return render_template("index.html", dashboard_data=dashboard_data)
+@bp.route("/")
+def home():
+    dashboard_snapshot.ensure_started()
+    dashboard_data, snapshot_age = dashboard_snapshot.get()
+
+    if dashboard_data is None:
+        # No snapshot yet (first hit, or background refresh disabled).
+        dashboard_data = {
+            "wip_batches_count": 0,
+            "open_pos_count": 0,
+            "low_stock_count": 0,
+        }
+        try:
+            dashboard_data = compute_dashboard_data(get_db())
+            dashboard_snapshot.store(dashboard_data)
+            snapshot_age = 0
+        except psycopg2.Error as e:
+            flash(f"Error fetching dashboard data: {e}", "error")
+            print(f"DB Error fetching dashboard data: {e}")
+
+    return render_template(
+        "index.html", dashboard_data=dashboard_data, snapshot_age=snapshot_age
+    )
 
 
 # --- NEW ROUTE TO SET THE SESSION VARIABLE ---
@@ -102,7 +85,7 @@ def set_forecast():
     try:
         # Validate and save to session
         forecast_months = int(months)
-        if forecast_months not in [1, 2, 3, 6]:  # Only allow specific values
+        if forecast_months not in FORECAST_MONTHS:  # Only allow specific values
             raise ValueError("Invalid forecast period")
 
         session["forecast_months"] = forecast_months
@@ -117,128 +100,23 @@ def set_forecast():
 
 # --- MODIFIED REQUIREMENTS ROUTE ---
 @bp.route("/requirements")
+@versioned(*REPORT_DOMAINS, vary=_forecast_months)
 def requirements_page():
-    conn = get_db()
+    conn = get_db(read_only=True)
     sorted_report_data = []
 
     try:
         # --- GET THE MULTIPLIER FROM THE SESSION (DEFAULT TO 1) ---
         forecast_months = session.get("forecast_months", 1)
 
-        inventory_levels = {}
-        product_needs = defaultdict(lambda: {"min_total": 0, "stock_total": 0})
-
-        recipe_cache = {}
-
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(
-                "SELECT id, name, unit, quantity_on_hand, quantity_allocated FROM inventory_items;"
-            )
-            for item in cur.fetchall():
-                inventory_levels[item["id"]] = {
-                    "name": item["name"],
-                    "unit": item["unit"],
-                    "on_hand": float(item.get("quantity_on_hand", 0)),
-                    "allocated": float(item.get("quantity_allocated", 0)),
-                    "available": float(item.get("quantity_on_hand", 0))
-                    - float(item.get("quantity_allocated", 0)),
-                }
-
-            cur.execute(
-                "SELECT product_id, SUM(min_jars) as total_min FROM stock_minimums GROUP BY product_id;"
-            )
-            for row in cur.fetchall():
-                product_needs[row["product_id"]]["min_total"] = float(row["total_min"])
-
-            cur.execute(
-                "SELECT product_id, SUM(quantity) as total_stock FROM location_stock GROUP BY product_id;"
-            )
-            for row in cur.fetchall():
-                product_needs[row["product_id"]]["stock_total"] = float(
-                    row["total_stock"]
-                )
-
-            all_base_ingredients = []
-            for product_id, needs in product_needs.items():
-
-                # --- APPLY THE MULTIPLIER HERE ---
-                scaled_min_total = float(needs["min_total"]) * forecast_months
-                jars_to_produce = max(0, scaled_min_total - needs["stock_total"])
-
-                if jars_to_produce > 0:
-                    cur.execute(
-                        """
-                        SELECT recipe_id, jars_per_batch 
-                        FROM products 
-                        WHERE id = %s AND jars_per_batch IS NOT NULL AND jars_per_batch > 0;
-                    """,
-                        (product_id,),
-                    )
-                    prod_info = cur.fetchone()
-
-                    if prod_info:
-                        recipe_id = prod_info["recipe_id"]
-                        jars_per_batch = float(prod_info["jars_per_batch"])
-
-                        # --- THIS CALCULATION NOW USES THE SCALED VALUE ---
-                        batches_needed = math.ceil(jars_to_produce / jars_per_batch)
-
-                        base_ingredients_one_batch = get_base_ingredients(
-                            recipe_id, conn, recipe_cache
-                        )
-                        for ing in base_ingredients_one_batch:
-                            scaled_ing = dict(ing)
-                            scaled_ing["quantity"] = (
-                                float(scaled_ing["quantity"]) * batches_needed
-                            )
-                            all_base_ingredients.append(scaled_ing)
-
-            totals_needed = defaultdict(
-                lambda: {
-                    "name": "",
-                    "unit": "",
-                    "total_needed": 0,
-                    "inventory_item_id": None,
-                }
-            )
-            for ing in all_base_ingredients:
-                inv_item_id = ing.get("inventory_item_id")
-                if inv_item_id:
-                    name = ing.get("name", "Unknown").strip()
-                    unit = ing.get("unit", "Unknown").strip()
-                    key = inv_item_id
-                    totals_needed[key]["name"] = name
-                    totals_needed[key]["unit"] = unit
-                    totals_needed[key]["inventory_item_id"] = inv_item_id
-                    totals_needed[key]["total_needed"] += float(ing.get("quantity", 0))
-
-            report_data = []
-            for inv_id, needed_data in totals_needed.items():
-                inv_info = inventory_levels.get(
-                    inv_id, {"on_hand": 0, "allocated": 0, "available": 0}
-                )
-                total_needed = needed_data["total_needed"]
-                available = inv_info["available"]
-                net_needed = max(0, total_needed - available)
-                if net_needed > 0:
-                    report_data.append(
-                        {
-                            "name": needed_data["name"],
-                            "unit": needed_data["unit"],
-                            "total_needed": round(total_needed, 2),
-                            "on_hand": round(inv_info["on_hand"], 2),
-                            "allocated": round(inv_info["allocated"], 2),
-                            "available": round(available, 2),
-                            "net_needed": round(net_needed, 2),
-                        }
-                    )
-        sorted_report_data = sorted(report_data, key=lambda x: x["name"])
+        sorted_report_data = get_requirements_report(conn, forecast_months)
 
     except psycopg2.Error as e:
         flash(f"Error generating requirements report: {e}", "error")
         print(f"DB Error requirements page: {e}")
 
     # --- PASS THE CURRENT VALUE TO THE TEMPLATE ---
+    release_db()
     return render_template(
         "requirements.html",
         report_data=sorted_report_data,
@@ -246,133 +124,246 @@ def requirements_page():
     )
 
 
+@bp.route("/requirements/scenarios")
+@versioned(*REPORT_DOMAINS)
+def requirements_scenarios():
+    """
+    Side-by-side net requirements for every forecast horizon, plus any
+    custom multipliers passed as ?custom=1.5,4 — all computed in one pass.
+    """
+    conn = get_db(read_only=True)
+    report_data = []
+
+    scenarios = [
+        (f"{m} Month" if m == 1 else f"{m} Months", float(m)) for m in FORECAST_MONTHS
+    ]
+    custom_str = request.args.get("custom", "")
+    for value in custom_str.split(","):
+        if not value.strip():
+            continue
+        try:
+            multiplier = float(value)
+            if multiplier <= 0:
+                raise ValueError("Multiplier must be positive")
+        except ValueError:
+            flash(f"Ignored invalid multiplier '{value.strip()}'.", "warning")
+            continue
+        if len(scenarios) - len(FORECAST_MONTHS) >= MAX_CUSTOM_SCENARIOS:
+            flash(
+                f"Only {MAX_CUSTOM_SCENARIOS} custom multipliers are compared.",
+                "warning",
+            )
+            break
+        scenarios.append((f"×{multiplier:g}", multiplier))
+
+    try:
+        report_data = compare_scenarios(conn, [m for _, m in scenarios])
+    except psycopg2.Error as e:
+        flash(f"Error generating scenario comparison: {e}", "error")
+        print(f"DB Error requirements scenarios: {e}")
+
+    release_db()
+    return render_template(
+        "requirements_scenarios.html",
+        report_data=report_data,
+        scenario_labels=[label for label, _ in scenarios],
+        custom=custom_str,
+    )
+
+
+@bp.route("/shortages")
+@versioned(*REPORT_DOMAINS, vary=_forecast_months)
+def shortages_page():
+    """
+    Which sold products and WIP batches each short ingredient is holding
+    up, for the forecast period currently selected on the requirements page.
+    """
+    conn = get_db(read_only=True)
+    shortages = []
+    forecast_months = session.get("forecast_months", 1)
+
+    try:
+        shortages = shortage_impact(conn, forecast_months)
+    except psycopg2.Error as e:
+        flash(f"Error generating shortage report: {e}", "error")
+        print(f"DB Error shortages page: {e}")
+
+    release_db()
+    return render_template(
+        "shortages.html", shortages=shortages, current_months=forecast_months
+    )
+
+
+def _planner_model(conn):
+    """
+    Sellable products (by id, in name order) and their BOM matrix. Shared
+    by every planner request until the next write to the data it uses.
+    """
+
+    def load():
+        products = load_sellable_products(conn)
+        bom = BomMatrix.load(conn, [p["recipe_id"] for p in products])
+        return {p["id"]: p for p in products}, bom
+
+    return planner_memo.get_or_compute(
+        "planner-model", versions_key(conn, PLANNER_DOMAINS), load
+    )
+
+
+def _planner_requirements(conn, jars_by_product):
+    """
+    Requirement rows for a {product_id: jars} run. Identical runs are
+    computed once per data version, however many requests ask at once.
+    """
+    run = tuple(
+        sorted((pid, jars) for pid, jars in jars_by_product.items() if jars > 0)
+    )
+
+    def compute():
+        products, bom = _planner_model(conn)
+        batches_to_make = []
+        for product_id, jars_to_make in run:
+            product = products.get(product_id)
+            if product:
+                batches_needed = math.ceil(
+                    jars_to_make / float(product["jars_per_batch"])
+                )
+                batches_to_make.append((product["recipe_id"], batches_needed))
+        totals = bom.total_needed(bom.batch_vector(batches_to_make))
+        return bom.item_rows(totals, totals > 0)
+
+    return planner_memo.get_or_compute(
+        ("planner", run), versions_key(conn, PLANNER_DOMAINS), compute
+    )
+
+
 @bp.route("/planner", methods=["GET", "POST"])
 def production_planner():
-    conn = get_db()
+    conn = get_db(read_only=True)
     calculated_requirements = None
-    inventory_levels = {}
     sellable_products = []
 
-    recipe_cache = {}
-
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(
-                "SELECT id, name, unit, quantity_on_hand, quantity_allocated FROM inventory_items;"
-            )
-            for item in cur.fetchall():
-                inventory_levels[item["id"]] = {
-                    "name": item["name"],
-                    "unit": item["unit"],
-                    "on_hand": float(item.get("quantity_on_hand", 0)),
-                    "allocated": float(item.get("quantity_allocated", 0)),
-                    "available": float(item.get("quantity_on_hand", 0))
-                    - float(item.get("quantity_allocated", 0)),
-                }
-            cur.execute(
-                """SELECT p.id, p.sku, p.product_name, p.jars_per_batch, r.id as recipe_id, r.name as recipe_name FROM products p JOIN recipes r ON p.recipe_id = r.id WHERE r.is_sold_product = TRUE AND p.jars_per_batch IS NOT NULL AND p.jars_per_batch > 0 ORDER BY p.product_name;"""
-            )
-            sellable_products = cur.fetchall()
+        products, _ = _planner_model(conn)
+        sellable_products = list(products.values())
 
         if request.method == "POST":
-            all_base_ingredients_run = []
+            jars_by_product = {}
             for product in sellable_products:
                 jars_to_make_str = request.form.get(f"jars_product_{product['id']}")
                 try:
                     jars_to_make = int(jars_to_make_str) if jars_to_make_str else 0
                 except ValueError:
                     jars_to_make = 0
-                if jars_to_make > 0:
-                    batches_needed = math.ceil(
-                        jars_to_make / float(product["jars_per_batch"])
-                    )
-                    base_ingredients_one_batch = get_base_ingredients(
-                        product["recipe_id"], conn, recipe_cache
-                    )
-                    for ing in base_ingredients_one_batch:
-                        scaled_ing = dict(ing)
-                        scaled_ing["quantity"] = (
-                            float(scaled_ing["quantity"]) * batches_needed
-                        )
-                        all_base_ingredients_run.append(scaled_ing)
-
-            totals_run_needed = defaultdict(
-                lambda: {
-                    "name": "",
-                    "unit": "",
-                    "total_needed": 0,
-                    "inventory_item_id": None,
-                }
-            )
-            for ing in all_base_ingredients_run:
-                inv_item_id = ing.get("inventory_item_id")
-                if inv_item_id:
-                    name = ing.get("name", "Unknown").strip()
-                    unit = ing.get("unit", "Unknown").strip()
-                    key = inv_item_id
-                    totals_run_needed[key]["name"] = name
-                    totals_run_needed[key]["unit"] = unit
-                    totals_run_needed[key]["inventory_item_id"] = inv_item_id
-                    totals_run_needed[key]["total_needed"] += float(
-                        ing.get("quantity", 0)
-                    )
-
-            run_report_data = []
-            for inv_id, needed_data in totals_run_needed.items():
-                inv_info = inventory_levels.get(inv_id, {"available": 0})
-                total_needed = needed_data["total_needed"]
-                available = inv_info["available"]
-                net_needed = max(0, total_needed - available)
-                run_report_data.append(
-                    {
-                        "name": needed_data["name"],
-                        "unit": needed_data["unit"],
-                        "total_needed": round(total_needed, 2),
-                        "available": round(available, 2),
-                        "net_needed": round(net_needed, 2),
-                    }
-                )
-            calculated_requirements = sorted(run_report_data, key=lambda x: x["name"])
+                jars_by_product[product["id"]] = jars_to_make
+
+            calculated_requirements = _planner_requirements(conn, jars_by_product)
 
     except psycopg2.Error as e:
         flash(f"Error in production planner: {e}", "error")
         print(f"DB Error planner page: {e}")
 
+    release_db()
     return render_template(
         "planner.html", products=sellable_products, requirements=calculated_requirements
     )
 
 
+@bp.route("/api/planner/requirements", methods=["POST"])
+def planner_requirements_api():
+    """
+    JSON version of the planner: takes {"<product_id>": jars, ...} and
+    returns the requirement rows, so the page can update as the user types.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"error": "Expected a JSON object of product_id: jars."}), 400
+
+    jars_by_product = {}
+    for product_id, jars in payload.items():
+        try:
+            jars = int(jars or 0)
+            if jars < 0:
+                raise ValueError("Jars cannot be negative")
+            jars_by_product[int(product_id)] = jars
+        except (TypeError, ValueError):
+            return jsonify({"error": f"Invalid jars for product {product_id}."}), 400
+
+    conn = get_db(read_only=True)
+    try:
+        requirements = _planner_requirements(conn, jars_by_product)
+        version = versions_key(conn, PLANNER_DOMAINS)
+    except psycopg2.Error as e:
+        print(f"DB Error planner API: {e}")
+        return jsonify({"error": "Database error calculating requirements."}), 500
+
+    release_db()
+    return jsonify({"requirements": requirements, "version": list(version)})
+
+
+@bp.route("/planner/max-producible")
+@versioned(*PLANNER_DOMAINS)
+def max_producible_page():
+    """
+    The reverse of the planner: how much of each product current stock
+    can make. ?mode=joint also shares the stock across products.
+    """
+    conn = get_db(read_only=True)
+    joint = request.args.get("mode") == "joint"
+    products = []
+
+    try:
+        fallback = False
+        try:
+            products = max_producible(conn, joint=joint)
+        except ImportError:
+            flash("Joint allocation needs SciPy installed on the server.", "error")
+            fallback = True
+        except ValueError as e:
+            flash(str(e), "error")
+            fallback = True
+        if fallback:
+            joint = False
+            products = max_producible(conn)
+    except psycopg2.Error as e:
+        flash(f"Error calculating producible quantities: {e}", "error")
+        print(f"DB Error max producible: {e}")
+
+    release_db()
+    return render_template("max_producible.html", products=products, joint=joint)
+
+
 @bp.route("/totals")
+@versioned("recipes", "inventory")
 def ingredient_totals():
-    conn = get_db()
+    conn = get_db(read_only=True)
     sorted_totals = []
 
-    recipe_cache = {}
-
     try:
-        all_base_ingredients = []
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT id FROM recipes;")
-            all_recipe_ids = cur.fetchall()
-            for rec_id in all_recipe_ids:
-                all_base_ingredients.extend(
-                    get_base_ingredients(rec_id["id"], conn, recipe_cache)
-                )
-
-        totals = defaultdict(lambda: {"name": "", "unit": "", "total_quantity": 0})
-        for ing in all_base_ingredients:
-            name = ing.get("name", "Unknown").strip()
-            unit = ing.get("unit", "Unknown").strip()
-            key = (name.lower(), unit.lower())
-            totals[key]["name"] = name
-            totals[key]["unit"] = unit
-            totals[key]["total_quantity"] += float(ing.get("quantity", 0))
+            cur.execute(
+                """
+                SELECT MIN(TRIM(inv.name)) AS name, MIN(TRIM(inv.unit)) AS unit,
+                       SUM(rbi.quantity) AS total_quantity
+                FROM recipe_base_ingredients rbi
+                JOIN inventory_items inv ON inv.id = rbi.inventory_item_id
+                GROUP BY LOWER(TRIM(inv.name)), LOWER(TRIM(inv.unit));
+            """
+            )
+            totals = [
+                {
+                    "name": row["name"],
+                    "unit": row["unit"],
+                    "total_quantity": float(row["total_quantity"]),
+                }
+                for row in cur.fetchall()
+            ]
 
-        sorted_totals = sorted(totals.values(), key=lambda x: x["name"])
+        sorted_totals = sorted(totals, key=lambda x: x["name"])
 
     except psycopg2.Error as e:
         flash(f"Error calculating totals: {e}", "error")
         print(f"DB Error ingredient totals: {e}")
 
+    release_db()
     return render_template("totals.html", totals=sorted_totals)
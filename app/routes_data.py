@@ -1,17 +1,70 @@
 import psycopg2
 from psycopg2.extras import DictCursor, RealDictCursor
-from flask import Blueprint, flash, g, redirect, render_template, request, url_for
-from collections import defaultdict
+from flask import (
+    Blueprint,
+    flash,
+    g,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    url_for,
+)
 import json
-
-from app.db import get_db
-from app.models import get_base_ingredients, _log_inventory_adjustment
+import math
+
+from app.db import get_db, release_db
+from app.importer import IMPORTERS
+from app.listing import ListQuery
+from app.memo import autocomplete_memo
+from app.models import (
+    get_recipe_dashboard,
+    refresh_recipe_base_ingredients,
+)
+from app.versions import bump_version, versioned, versions_key
 
 # --- All data management routes ---
 bp = Blueprint("data", __name__)
 
 
 # --- Helper function for saving recipe ingredients (DRY) ---
+def _check_sub_recipe_cycles(cur, recipe_id, sub_recipe_ids):
+    """
+    Raises ValueError if any of 'sub_recipe_ids' already uses 'recipe_id',
+    directly or further down its tree. Runs in the caller's transaction,
+    so it sees every committed recipe edit.
+    """
+    if not sub_recipe_ids:
+        return
+    if recipe_id in sub_recipe_ids:
+        raise ValueError("A recipe cannot use itself as a sub-recipe.")
+    # Serializes sub-recipe edits, so two concurrent saves cannot each
+    # pass this check and together form a cycle.
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('recipe_sub_recipes'));")
+    cur.execute(
+        """WITH RECURSIVE reachable (root_id, id) AS (
+               SELECT s, s FROM unnest(%s::int[]) AS s
+               UNION
+               SELECT r.root_id, i.sub_recipe_id
+               FROM reachable r
+               JOIN ingredients i ON i.recipe_id = r.id
+               WHERE i.sub_recipe_id IS NOT NULL
+           )
+           SELECT DISTINCT rc.name
+           FROM reachable r JOIN recipes rc ON rc.id = r.root_id
+           WHERE r.id = %s
+           ORDER BY rc.name;""",
+        (sorted(set(sub_recipe_ids)), recipe_id),
+    )
+    offending = [row[0] for row in cur.fetchall()]
+    if offending:
+        raise ValueError(
+            "Sub-recipe would create a cycle: recipe(s) "
+            + ", ".join(offending)
+            + " already use this recipe."
+        )
+
+
 def _process_and_save_ingredients(cur, recipe_id):
     """
     Reads ingredient form data from the request and saves it
@@ -25,6 +78,17 @@ def _process_and_save_ingredients(cur, recipe_id):
         flash("Form data inconsistency.", "error")
         raise ValueError("Form list lengths mismatch")
 
+    # Reject sub-recipe links that would make the recipe use itself.
+    _check_sub_recipe_cycles(
+        cur,
+        recipe_id,
+        [
+            int(sub_recipe_ids[i])
+            for i in range(len(sub_recipe_ids))
+            if sub_recipe_ids[i] and not inventory_item_ids[i]
+        ],
+    )
+
     for i in range(len(quantities)):
         inventory_item_id = inventory_item_ids[i] if inventory_item_ids[i] else None
         sub_recipe_id = sub_recipe_ids[i] if sub_recipe_ids[i] else None
@@ -79,78 +143,74 @@ def _process_and_save_ingredients(cur, recipe_id):
             ),
         )
 
+    # Keep the materialized BOM of this recipe and its ancestors in step.
+    refresh_recipe_base_ingredients(cur, [recipe_id])
+
 
 # --- Recipe Routes ---
+RECIPE_PAGE_SIZE = 30
+
+
 @bp.route("/recipes")
+@versioned("recipes", "inventory")
 def recipe_dashboard():
     recipes_list = []
-    conn = get_db()
-
-    # --- Use request-local cache ---
-    recipe_cache = {}
-
+    total = 0
+    search = request.args.get("q", "").strip()
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT * FROM recipes ORDER BY name;")
-            recipes_from_db = cur.fetchall()
-            for recipe in recipes_from_db:
-                recipe_dict = dict(recipe)
-                cur.execute(
-                    """SELECT i.quantity, i.sub_recipe_id, COALESCE(inv.name, r_sub.name, i.name, 'Unknown') as name, COALESCE(inv.unit, i.unit, 'N/A') as unit 
-                       FROM ingredients i 
-                       LEFT JOIN inventory_items inv ON i.inventory_item_id = inv.id 
-                       LEFT JOIN recipes r_sub ON i.sub_recipe_id = r_sub.id 
-                       WHERE i.recipe_id = %s;""",
-                    (recipe["id"],),
-                )
-                recipe_dict["ingredients"] = [dict(ing) for ing in cur.fetchall()]
-                base_ingredients_for_totals = get_base_ingredients(
-                    recipe["id"], conn, recipe_cache
-                )
+        page = max(int(request.args.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+    conn = get_db(read_only=True)
 
-                totals = {"grams": 0, "mLs": 0}
-                for ing in base_ingredients_for_totals:
-                    unit = ing.get("unit", "").lower()
-                    quantity = float(ing.get("quantity", 0))
-                    if unit == "grams":
-                        totals["grams"] += quantity
-                    elif unit == "mls":
-                        totals["mLs"] += quantity
-                recipe_dict["totals"] = {
-                    "grams": round(totals["grams"], 2),
-                    "mLs": round(totals["mLs"], 2),
-                }
-                recipes_list.append(recipe_dict)
+    try:
+        recipes_list, total = get_recipe_dashboard(conn, search, page, RECIPE_PAGE_SIZE)
     except psycopg2.Error as e:
         flash(f"Error fetching recipes: {e}", "error")
         print(f"DB Error fetching recipes: {e}")
 
-    return render_template("recipes.html", recipes=recipes_list)
+    release_db()
+    return render_template(
+        "recipes.html",
+        recipes=recipes_list,
+        search=search,
+        page=page,
+        page_count=max(math.ceil(total / RECIPE_PAGE_SIZE), 1),
+        total=total,
+    )
 
 
 @bp.route("/new-recipe")
 def new_recipe_form():
-    conn = get_db()
-    recipes = []
-    inventory_items = []
-    try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT id, name FROM recipes ORDER BY name;")
-            recipes = cur.fetchall()
-            cur.execute("SELECT id, name, unit FROM inventory_items ORDER BY name;")
-            inventory_items = cur.fetchall()
-    except psycopg2.Error as e:
-        flash(f"Error fetching data: {e}", "error")
-        print(f"DB Error new recipe form: {e}")
-
     # --- Use the new unified form template ---
-    return render_template(
-        "recipe_form.html",
-        recipe=None,
-        ingredients=[],
-        recipes=recipes,
-        inventory_items=inventory_items,
-    )
+    return render_template("recipe_form.html", recipe=None, ingredients=[])
+
+
+def _with_option_labels(conn, ingredients):
+    """
+    Adds the display text of each line's selected raw material and
+    sub-recipe; the autocomplete selects preload only that one option.
+    """
+    item_ids = [
+        ing["inventory_item_id"] for ing in ingredients if ing["inventory_item_id"]
+    ]
+    sub_ids = [ing["sub_recipe_id"] for ing in ingredients if ing["sub_recipe_id"]]
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT id, name || ' (' || unit || ')' FROM inventory_items WHERE id = ANY(%s);",
+            (item_ids,),
+        )
+        item_labels = dict(cur.fetchall())
+        cur.execute("SELECT id, name FROM recipes WHERE id = ANY(%s);", (sub_ids,))
+        recipe_names = dict(cur.fetchall())
+    return [
+        dict(
+            ing,
+            item_label=item_labels.get(ing["inventory_item_id"]),
+            sub_recipe_name=recipe_names.get(ing["sub_recipe_id"]),
+        )
+        for ing in ingredients
+    ]
 
 
 @bp.route("/recipes/create", methods=["POST"])
@@ -160,8 +220,6 @@ def create_recipe():
     # --- FIX: Define variables in outer scope for error handling ---
     recipe_data_on_fail = None
     ingredients_on_fail = []
-    recipes = []
-    inventory_items = []
 
     try:
         with conn.cursor() as cur:
@@ -194,6 +252,7 @@ def create_recipe():
             recipe_id = cur.fetchone()[0]
 
             _process_and_save_ingredients(cur, recipe_id)
+            bump_version(cur, "recipes")
 
         conn.commit()
         flash("Recipe created successfully!", "success")
@@ -253,14 +312,8 @@ def create_recipe():
                 )
 
         try:
-            # Still need to fetch these for the dropdowns
-            with conn.cursor(cursor_factory=DictCursor) as cur_err:
-                cur_err.execute("SELECT id, name FROM recipes ORDER BY name;")
-                recipes = cur_err.fetchall()
-                cur_err.execute(
-                    "SELECT id, name, unit FROM inventory_items ORDER BY name;"
-                )
-                inventory_items = cur_err.fetchall()
+            # Still need the names of the options that were selected
+            ingredients_on_fail = _with_option_labels(conn, ingredients_on_fail)
         except psycopg2.Error as fetch_e:
             flash(f"Error fetching form data: {fetch_e}", "error")
 
@@ -268,8 +321,6 @@ def create_recipe():
             "recipe_form.html",
             recipe=recipe_data_on_fail,
             ingredients=ingredients_on_fail,
-            recipes=recipes,
-            inventory_items=inventory_items,
         )
         # --- END FIX ---
 
@@ -279,8 +330,6 @@ def edit_recipe_form(recipe_id):
     conn = get_db()
     recipe = None
     ingredients = []
-    all_recipes = []
-    inventory_items = []
     try:
         with conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute("SELECT * FROM recipes WHERE id = %s;", (recipe_id,))
@@ -290,24 +339,14 @@ def edit_recipe_form(recipe_id):
                 return redirect(url_for("data.recipe_dashboard"))
 
             cur.execute("SELECT * FROM ingredients WHERE recipe_id = %s;", (recipe_id,))
-            ingredients = cur.fetchall()
-            cur.execute("SELECT id, name FROM recipes ORDER BY name;")
-            all_recipes = cur.fetchall()
-            cur.execute("SELECT id, name, unit FROM inventory_items ORDER BY name;")
-            inventory_items = cur.fetchall()
+            ingredients = _with_option_labels(conn, cur.fetchall())
     except psycopg2.Error as e:
         flash(f"Error fetching data: {e}", "error")
         print(f"DB Error edit recipe form {recipe_id}: {e}")
         return redirect(url_for("data.recipe_dashboard"))
 
     # --- Use the new unified form template ---
-    return render_template(
-        "recipe_form.html",
-        recipe=recipe,
-        ingredients=ingredients,
-        recipes=all_recipes,
-        inventory_items=inventory_items,
-    )
+    return render_template("recipe_form.html", recipe=recipe, ingredients=ingredients)
 
 
 @bp.route("/recipes/update/<int:recipe_id>", methods=["POST"])
@@ -348,6 +387,7 @@ def update_recipe(recipe_id):
 
             cur.execute("DELETE FROM ingredients WHERE recipe_id = %s;", (recipe_id,))
             _process_and_save_ingredients(cur, recipe_id)
+            bump_version(cur, "recipes")
 
         conn.commit()
         flash("Recipe updated successfully!", "success")
@@ -388,11 +428,25 @@ def delete_recipe(recipe_id):
                 )
                 return redirect(url_for("data.recipe_dashboard"))
 
+            # Recipes using this one as a sub-recipe need their BOM rebuilt.
+            cur.execute(
+                "SELECT DISTINCT recipe_id FROM ingredients WHERE sub_recipe_id = %s;",
+                (recipe_id,),
+            )
+            parent_recipe_ids = [row[0] for row in cur.fetchall()]
+
             # It's safe to delete. Delete ingredients first.
             cur.execute("DELETE FROM ingredients WHERE recipe_id = %s;", (recipe_id,))
+            cur.execute(
+                "DELETE FROM recipe_base_ingredients WHERE recipe_id = %s;",
+                (recipe_id,),
+            )
             cur.execute("DELETE FROM recipes WHERE id = %s;", (recipe_id,))
             # --- END FIX ---
+            if parent_recipe_ids:
+                refresh_recipe_base_ingredients(cur, parent_recipe_ids)
 
+            bump_version(cur, "recipes")
             conn.commit()
             flash("Recipe deleted.", "success")
     except psycopg2.Error as e:
@@ -406,20 +460,29 @@ def delete_recipe(recipe_id):
 
 
 # --- Product Routes ---
+PRODUCT_LIST = ListQuery(
+    """SELECT p.id, p.sku, p.product_name, p.jars_per_batch, r.name AS recipe_name
+       FROM products p
+       LEFT JOIN recipes r ON p.recipe_id = r.id""",
+    sorts={
+        "product_name": [("COALESCE(LOWER(product_name), '')", False), ("id", False)],
+        "sku": [("LOWER(sku)", False), ("id", False)],
+    },
+    default_sort="product_name",
+    search=["sku", "product_name", "recipe_name"],
+)
+
+
 @bp.route("/products")
 def products_page():
-    conn = get_db()
-    products = []
+    conn = get_db(read_only=True)
+    products = PRODUCT_LIST.empty()
     recipes = []
     try:
+        products, error = PRODUCT_LIST.fetch(conn)
+        if error:
+            flash(error, "warning")
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(
-                """SELECT p.id, p.sku, p.product_name, p.jars_per_batch, r.name as recipe_name 
-                   FROM products p 
-                   LEFT JOIN recipes r ON p.recipe_id = r.id 
-                   ORDER BY p.product_name, p.sku;"""
-            )
-            products = cur.fetchall()
             cur.execute(
                 "SELECT id, name FROM recipes WHERE is_sold_product = TRUE ORDER BY name;"
             )
@@ -428,6 +491,7 @@ def products_page():
         flash(f"Error fetching products: {e}", "error")
         print(f"DB Error products page: {e}")
 
+    release_db()
     return render_template("products.html", products=products, recipes=recipes)
 
 
@@ -444,6 +508,7 @@ def add_product():
                 "INSERT INTO products (sku, product_name, recipe_id, jars_per_batch) VALUES (%s, %s, %s, %s);",
                 (sku, product_name, recipe_id, jars_per_batch),
             )
+            bump_version(cur, "products")
             conn.commit()
             flash("Product added.", "success")
     except psycopg2.Error as e:
@@ -492,6 +557,7 @@ def update_product(id):
                 "UPDATE products SET sku = %s, product_name = %s, recipe_id = %s, jars_per_batch = %s WHERE id = %s;",
                 (sku, product_name, recipe_id, jars_per_batch, id),
             )
+            bump_version(cur, "products")
             conn.commit()
             flash("Product updated.", "success")
     except psycopg2.Error as e:
@@ -509,6 +575,7 @@ def delete_product(id):
     try:
         with conn.cursor() as cur:
             cur.execute("DELETE FROM products WHERE id = %s;", (id,))
+            bump_version(cur, "products")
             conn.commit()
             flash("Product deleted.", "success")
     except psycopg2.Error as e:
@@ -521,10 +588,18 @@ def delete_product(id):
 
 
 # --- Location Routes ---
+LOCATION_LIST = ListQuery(
+    "SELECT * FROM locations",
+    sorts={"name": [("LOWER(name)", False), ("id", False)]},
+    default_sort="name",
+    search=["name"],
+)
+
+
 @bp.route("/locations", methods=["GET", "POST"])
 def locations_page():
-    conn = get_db()
-    locations = []
+    conn = get_db(read_only=request.method == "GET")
+    locations = LOCATION_LIST.empty()
     try:
         if request.method == "POST":
             location_name = request.form["name"]
@@ -532,20 +607,22 @@ def locations_page():
                 cur.execute(
                     "INSERT INTO locations (name) VALUES (%s);", (location_name,)
                 )
+                bump_version(cur, "locations")
                 conn.commit()
                 flash("Location added.", "success")
             return redirect(url_for("data.locations_page"))
 
         # GET request
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT * FROM locations ORDER BY name;")
-            locations = cur.fetchall()
+        locations, error = LOCATION_LIST.fetch(conn)
+        if error:
+            flash(error, "warning")
     except psycopg2.Error as e:
         if conn and request.method == "POST":
             conn.rollback()
         flash(f"Error accessing locations: {e}", "error")
         print(f"DB Error locations page: {e}")
 
+    release_db()
     return render_template("locations.html", locations=locations)
 
 
@@ -555,6 +632,7 @@ def delete_location(id):
     try:
         with conn.cursor() as cur:
             cur.execute("DELETE FROM locations WHERE id = %s;", (id,))
+            bump_version(cur, "locations")
             conn.commit()
             flash("Location deleted.", "success")
     except psycopg2.Error as e:
@@ -567,18 +645,27 @@ def delete_location(id):
 
 
 # --- Supplier Routes ---
+SUPPLIER_LIST = ListQuery(
+    "SELECT * FROM suppliers",
+    sorts={"name": [("LOWER(name)", False), ("id", False)]},
+    default_sort="name",
+    search=["name", "contact_person", "email"],
+)
+
+
 @bp.route("/suppliers", methods=["GET"])
 def suppliers_page():
-    conn = get_db()
-    suppliers = []
+    conn = get_db(read_only=True)
+    suppliers = SUPPLIER_LIST.empty()
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT * FROM suppliers ORDER BY name;")
-            suppliers = cur.fetchall()
+        suppliers, error = SUPPLIER_LIST.fetch(conn)
+        if error:
+            flash(error, "warning")
     except psycopg2.Error as e:
         flash(f"Error fetching suppliers: {e}", "error")
         print(f"DB Error suppliers page GET: {e}")
 
+    release_db()
     return render_template("suppliers.html", suppliers=suppliers)
 
 
@@ -604,6 +691,7 @@ def add_supplier():
                     "INSERT INTO suppliers (name, contact_person, email, phone, website, notes) VALUES (%s, %s, %s, %s, %s, %s);",
                     (name, contact, email, phone, website, notes),
                 )
+                bump_version(cur, "suppliers")
                 conn.commit()
                 flash("Supplier added.", "success")
     except psycopg2.Error as e:
@@ -660,6 +748,7 @@ def update_supplier(id):
                     """UPDATE suppliers SET name=%s, contact_person=%s, email=%s, phone=%s, website=%s, notes=%s WHERE id=%s;""",
                     (name, contact, email, phone, website, notes, id),
                 )
+                bump_version(cur, "suppliers")
                 conn.commit()
                 flash("Supplier updated.", "success")
     except psycopg2.Error as e:
@@ -678,6 +767,7 @@ def delete_supplier(id):
     try:
         with conn.cursor() as cur:
             cur.execute("DELETE FROM suppliers WHERE id = %s;", (id,))
+            bump_version(cur, "suppliers")
             conn.commit()
             flash("Supplier deleted.", "success")
     except psycopg2.Error as e:
@@ -693,10 +783,23 @@ def delete_supplier(id):
 
 
 # --- Inventory Item Routes ---
+INVENTORY_LIST = ListQuery(
+    """SELECT *, (quantity_on_hand - quantity_allocated) AS quantity_available
+       FROM inventory_items""",
+    sorts={
+        "name": [("LOWER(name)", False), ("id", False)],
+        "id": [("id", False)],
+    },
+    default_sort="name",
+    search=["name"],
+)
+
+
 @bp.route("/inventory", methods=["GET", "POST"])
+@versioned("inventory")
 def inventory_items_page():
-    conn = get_db()
-    inventory_items = []
+    conn = get_db(read_only=request.method == "GET")
+    inventory_items = INVENTORY_LIST.empty()
     try:
         if request.method == "POST":
             name = request.form["name"]
@@ -717,6 +820,7 @@ def inventory_items_page():
                         "INSERT INTO inventory_items (name, unit, quantity_on_hand) VALUES (%s, %s, %s);",
                         (name, unit, qty_on_hand),
                     )
+                    bump_version(cur, "inventory")
                     conn.commit()
                     flash("Item added.", "success")
                 else:
@@ -724,17 +828,16 @@ def inventory_items_page():
             return redirect(url_for("data.inventory_items_page"))
 
         # GET
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(
-                "SELECT *, (quantity_on_hand - quantity_allocated) as quantity_available FROM inventory_items ORDER BY name;"
-            )
-            inventory_items = cur.fetchall()
+        inventory_items, error = INVENTORY_LIST.fetch(conn)
+        if error:
+            flash(error, "warning")
     except psycopg2.Error as e:
         if conn and request.method == "POST":
             conn.rollback()
         flash(f"Error accessing inventory: {e}", "error")
         print(f"DB Error inventory page: {e}")
 
+    release_db()
     return render_template("inventory_items.html", inventory_items=inventory_items)
 
 
@@ -742,7 +845,7 @@ def inventory_items_page():
 def edit_inventory_item(id):
     conn = get_db()
     item = None
-    recipes = []
+    linked_recipe = None
     try:
         with conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute("SELECT * FROM inventory_items WHERE id = %s;", (id,))
@@ -750,14 +853,20 @@ def edit_inventory_item(id):
             if item is None:
                 flash(f"Item ID {id} not found.", "error")
                 return redirect(url_for("data.inventory_items_page"))
-            cur.execute("SELECT id, name FROM recipes ORDER BY name;")
-            recipes = cur.fetchall()
+            if item["linked_recipe_id"]:
+                cur.execute(
+                    "SELECT id, name FROM recipes WHERE id = %s;",
+                    (item["linked_recipe_id"],),
+                )
+                linked_recipe = cur.fetchone()
     except psycopg2.Error as e:
         flash(f"Error fetching item: {e}", "error")
         print(f"DB Error edit inventory item GET {id}: {e}")
         return redirect(url_for("data.inventory_items_page"))
 
-    return render_template("edit_inventory_item.html", item=item, recipes=recipes)
+    return render_template(
+        "edit_inventory_item.html", item=item, linked_recipe=linked_recipe
+    )
 
 
 @bp.route("/inventory/update/<int:id>", methods=["POST"])
@@ -780,6 +889,7 @@ def update_inventory_item(id):
                 WHERE id = %s;""",
                 (name, unit, qty_on_hand, linked_recipe_id, id),
             )
+            bump_version(cur, "inventory")
         conn.commit()
         flash("Item updated successfully.", "success")
     except psycopg2.Error as e:
@@ -796,6 +906,7 @@ def delete_inventory_item(id):
     try:
         with conn.cursor() as cur:
             cur.execute("DELETE FROM inventory_items WHERE id = %s;", (id,))
+            bump_version(cur, "inventory")
         conn.commit()
         flash("Item deleted.", "success")
     except psycopg2.Error as e:
@@ -804,3 +915,135 @@ def delete_inventory_item(id):
         flash(f"Cannot delete item: {e.diag.message_primary}", "error")
 
     return redirect(url_for("data.inventory_items_page"))
+
+
+# --- Autocomplete (Select2 AJAX) ---
+AUTOCOMPLETE_LIMIT = 20
+AUTOCOMPLETE_MAX_LIMIT = 50
+
+# kind -> (data version domains, query). Names are matched by prefix,
+# served by the trigram indexes from migration 005.
+_AUTOCOMPLETE_QUERIES = {
+    "inventory-items": (
+        ("inventory",),
+        """SELECT id, name || ' (' || unit || ')' AS text
+           FROM inventory_items
+           WHERE name ILIKE %(prefix)s
+           ORDER BY LOWER(name), id
+           LIMIT %(limit)s OFFSET %(offset)s;""",
+    ),
+    "recipes": (
+        ("recipes",),
+        """SELECT id, name AS text
+           FROM recipes
+           WHERE name ILIKE %(prefix)s
+           ORDER BY LOWER(name), id
+           LIMIT %(limit)s OFFSET %(offset)s;""",
+    ),
+    "products": (
+        ("products", "recipes"),
+        """SELECT p.id, COALESCE(p.product_name, 'N/A') || ' (' || p.sku || ')' AS text
+           FROM products p
+           LEFT JOIN recipes r ON r.id = p.recipe_id
+           WHERE (p.product_name ILIKE %(prefix)s OR p.sku ILIKE %(prefix)s)
+             AND (NOT %(sold_only)s OR r.is_sold_product)
+           ORDER BY COALESCE(LOWER(p.product_name), ''), p.id
+           LIMIT %(limit)s OFFSET %(offset)s;""",
+    ),
+    "suppliers": (
+        ("suppliers",),
+        """SELECT id, name AS text
+           FROM suppliers
+           WHERE name ILIKE %(prefix)s
+           ORDER BY LOWER(name), id
+           LIMIT %(limit)s OFFSET %(offset)s;""",
+    ),
+}
+
+
+@bp.route("/api/autocomplete/<kind>")
+def autocomplete(kind):
+    """
+    Select2 AJAX source: ?q= (name prefix), ?page=, ?limit= and, for
+    products, ?sold_only=1. Returns {"results": [{id, text}],
+    "pagination": {"more": bool}}.
+    """
+    if kind not in _AUTOCOMPLETE_QUERIES:
+        return jsonify({"error": f"Unknown autocomplete list '{kind}'."}), 404
+    domains, sql = _AUTOCOMPLETE_QUERIES[kind]
+
+    q = request.args.get("q", "").strip()
+    try:
+        page = max(int(request.args.get("page", 1)), 1)
+        limit = min(
+            max(int(request.args.get("limit", AUTOCOMPLETE_LIMIT)), 1),
+            AUTOCOMPLETE_MAX_LIMIT,
+        )
+    except ValueError:
+        return jsonify({"error": "page and limit must be whole numbers."}), 400
+    sold_only = request.args.get("sold_only") == "1"
+    params = {
+        "prefix": q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%",
+        "limit": limit + 1,
+        "offset": (page - 1) * limit,
+        "sold_only": sold_only,
+    }
+
+    conn = get_db(read_only=True)
+
+    def search():
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(sql, params)
+            return cur.fetchall()
+
+    try:
+        rows = autocomplete_memo.get_or_compute(
+            (kind, q.lower(), page, limit, sold_only),
+            versions_key(conn, domains),
+            search,
+        )
+    except psycopg2.Error as e:
+        print(f"DB Error autocomplete {kind}: {e}")
+        return jsonify({"error": "Database error searching."}), 500
+
+    response = jsonify(
+        {"results": rows[:limit], "pagination": {"more": len(rows) > limit}}
+    )
+    response.headers["Cache-Control"] = "private, max-age=30"
+    return response
+
+
+# --- Bulk CSV Import ---
+@bp.route("/import", methods=["GET", "POST"])
+def bulk_import():
+    kind = request.form.get("kind") or request.args.get("kind", "inventory-items")
+    result = None
+    if request.method == "POST":
+        importer = IMPORTERS.get(kind)
+        upload = request.files.get("file")
+        if importer is None:
+            flash("Choose what to import.", "error")
+        elif upload is None or not upload.filename:
+            flash("Choose a CSV file to upload.", "error")
+        else:
+            conn = get_db()
+            try:
+                result = importer.run(conn, upload.stream)
+                conn.commit()
+            except ValueError as e:
+                conn.rollback()
+                result = None
+                flash(f"Nothing was imported: {e}", "error")
+            except psycopg2.Error as e:
+                conn.rollback()
+                result = None
+                flash(f"Error importing {importer.label.lower()}: {e}", "error")
+                print(f"DB Error bulk import {kind}: {e}")
+            else:
+                flash(
+                    f"{importer.label}: {result.inserted} added, {result.updated} updated, "
+                    f"{result.unchanged} unchanged, {result.error_count} row(s) skipped.",
+                    "warning" if result.error_count else "success",
+                )
+
+    return render_template("import.html", importers=IMPORTERS, kind=kind, result=result)
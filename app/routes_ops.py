@@ -1,12 +1,35 @@
 import psycopg2
 from psycopg2.extras import DictCursor, RealDictCursor
-from flask import Blueprint, flash, g, redirect, render_template, request, url_for
-from collections import defaultdict
+from flask import (
+    Blueprint,
+    Response,
+    flash,
+    g,
+    redirect,
+    render_template,
+    request,
+    stream_with_context,
+    url_for,
+)
+import csv
+import io
+import json
 import math
 from datetime import datetime
 
-from app.db import get_db
-from app.models import get_base_ingredients, _log_inventory_adjustment
+from app.db import get_db, release_db
+from app.inventory import (
+    allocate_to_batch,
+    complete_wip_batches,
+    move_po_stock,
+    receive_po_lines,
+    receive_purchase_orders,
+    record_stock_count,
+)
+from app.importer import read_csv
+from app.listing import ListQuery
+from app.models import _log_inventory_adjustment
+from app.versions import bump_version
 
 # --- All operational routes ---
 bp = Blueprint("ops", __name__)
@@ -17,7 +40,6 @@ bp = Blueprint("ops", __name__)
 def stock_minimums_page():
     conn = get_db()
     locations = []
-    products = []
     minimums = []
     try:
         if request.method == "POST":
@@ -31,6 +53,7 @@ def stock_minimums_page():
                        ON CONFLICT (product_id, location_id) DO UPDATE SET min_jars = EXCLUDED.min_jars;""",
                     (location_id, product_id, min_jars),
                 )
+                bump_version(cur, "stock_minimums")
                 conn.commit()
                 flash("Stock minimum set/updated.", "success")
             return redirect(url_for("ops.stock_minimums_page"))
@@ -39,12 +62,6 @@ def stock_minimums_page():
         with conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute("SELECT * FROM locations ORDER BY name;")
             locations = cur.fetchall()
-            cur.execute(
-                """SELECT p.id, p.sku, p.product_name, r.name as recipe_name 
-                   FROM products p JOIN recipes r ON p.recipe_id = r.id 
-                   WHERE r.is_sold_product = TRUE ORDER BY p.product_name, p.sku;"""
-            )
-            products = cur.fetchall()
             cur.execute(
                 """SELECT sm.id, l.name as location_name, p.sku, p.product_name, r.name as recipe_name, sm.min_jars 
                    FROM stock_minimums sm 
@@ -61,7 +78,7 @@ def stock_minimums_page():
         print(f"DB Error stock minimums page: {e}")
 
     return render_template(
-        "stock_minimums.html", locations=locations, products=products, minimums=minimums
+        "stock_minimums.html", locations=locations, minimums=minimums
     )
 
 
@@ -71,6 +88,7 @@ def delete_stock_minimum(id):
     try:
         with conn.cursor() as cur:
             cur.execute("DELETE FROM stock_minimums WHERE id = %s;", (id,))
+            bump_version(cur, "stock_minimums")
             conn.commit()
             flash("Stock minimum deleted.", "success")
     except psycopg2.Error as e:
@@ -83,12 +101,34 @@ def delete_stock_minimum(id):
 
 
 # --- Location Stock Routes ---
+LOCATION_STOCK_LIST = ListQuery(
+    """SELECT ls.id, l.name AS location_name, p.product_name, p.sku, ls.quantity
+       FROM location_stock ls
+       JOIN locations l ON ls.location_id = l.id
+       JOIN products p ON ls.product_id = p.id""",
+    sorts={
+        "location": [
+            ("LOWER(location_name)", False),
+            ("COALESCE(LOWER(product_name), '')", False),
+            ("id", False),
+        ],
+        "product": [
+            ("COALESCE(LOWER(product_name), '')", False),
+            ("LOWER(location_name)", False),
+            ("id", False),
+        ],
+    },
+    default_sort="location",
+    search=["location_name", "product_name", "sku"],
+)
+
+
 @bp.route("/location-stock", methods=["GET", "POST"])
 def location_stock_page():
-    conn = get_db()
+    conn = get_db(read_only=request.method == "GET")
     locations = []
     products = []
-    current_stock = []
+    current_stock = LOCATION_STOCK_LIST.empty()
 
     try:
         if request.method == "POST":
@@ -106,6 +146,7 @@ def location_stock_page():
                 """,
                     (location_id, product_id, quantity),
                 )
+                bump_version(cur, "location_stock")
                 conn.commit()
                 flash("Finished stock quantity updated.", "success")
             return redirect(url_for("ops.location_stock_page"))
@@ -124,16 +165,9 @@ def location_stock_page():
             """
             )
             products = cur.fetchall()
-            cur.execute(
-                """
-                SELECT ls.id, l.name as location_name, p.product_name, p.sku, ls.quantity
-                FROM location_stock ls
-                JOIN locations l ON ls.location_id = l.id
-                JOIN products p ON ls.product_id = p.id
-                ORDER BY l.name, p.product_name;
-            """
-            )
-            current_stock = cur.fetchall()
+        current_stock, error = LOCATION_STOCK_LIST.fetch(conn)
+        if error:
+            flash(error, "warning")
 
     except psycopg2.Error as e:
         if conn and request.method == "POST":
@@ -141,6 +175,7 @@ def location_stock_page():
         flash(f"Error accessing location stock: {e}", "error")
         print(f"DB Error location stock page: {e}")
 
+    release_db()
     return render_template(
         "location_stock.html",
         locations=locations,
@@ -149,6 +184,113 @@ def location_stock_page():
     )
 
 
+# --- Stock Count Routes ---
+STOCK_COUNT_COLUMNS = ("location", "sku", "quantity")
+# Skipped lines past this many are counted in the summary but not flashed.
+MAX_FLASHED_COUNT_ERRORS = 10
+
+
+@bp.route("/stock-counts", methods=["GET", "POST"])
+def stock_counts_page():
+    conn = get_db(read_only=request.method == "GET")
+    counts = []
+    try:
+        if request.method == "POST":
+            upload = request.files.get("file")
+            if upload is not None and upload.filename:
+                stream = upload.stream
+            else:
+                stream = io.BytesIO(request.form.get("sheet", "").encode("utf-8"))
+            notes = request.form.get("notes", "").strip() or None
+
+            try:
+                records = read_csv(stream, STOCK_COUNT_COLUMNS, STOCK_COUNT_COLUMNS)
+                with conn.cursor() as cur:
+                    count_id, changed, errors = record_stock_count(cur, records, notes)
+                    if changed:
+                        bump_version(cur, "location_stock")
+            except ValueError as e:
+                conn.rollback()
+                flash(f"Count sheet not applied: {e}", "error")
+                return redirect(url_for("ops.stock_counts_page"))
+
+            for line, message in errors[:MAX_FLASHED_COUNT_ERRORS]:
+                flash(f"Line {line}: {message}", "warning")
+            if count_id is None:
+                conn.rollback()
+                flash("Count sheet not applied: no line could be used.", "error")
+                return redirect(url_for("ops.stock_counts_page"))
+            conn.commit()
+            flash(
+                f"Stock count #{count_id} recorded: {changed} line(s) changed, "
+                f"{len(errors)} skipped.",
+                "warning" if errors else "success",
+            )
+            return redirect(url_for("ops.stock_count_detail", count_id=count_id))
+
+        # GET
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(
+                """SELECT sc.*, COUNT(v.id) AS lines_changed,
+                          COALESCE(SUM(v.counted_quantity - v.expected_quantity), 0)
+                              AS net_variance
+                   FROM stock_counts sc
+                   LEFT JOIN stock_count_variances v ON v.stock_count_id = sc.id
+                   GROUP BY sc.id
+                   ORDER BY sc.counted_at DESC, sc.id DESC
+                   LIMIT 50;"""
+            )
+            counts = cur.fetchall()
+    except psycopg2.Error as e:
+        if conn and request.method == "POST":
+            conn.rollback()
+        flash(f"Error accessing stock counts: {e}", "error")
+        print(f"DB Error stock counts page: {e}")
+        if request.method == "POST":
+            return redirect(url_for("ops.stock_counts_page"))
+
+    release_db()
+    return render_template("stock_counts.html", counts=counts)
+
+
+@bp.route("/stock-counts/<int:count_id>")
+def stock_count_detail(count_id):
+    conn = get_db(read_only=True)
+    variances = []
+    try:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute("SELECT * FROM stock_counts WHERE id = %s;", (count_id,))
+            count = cur.fetchone()
+            if not count:
+                flash(f"Stock count #{count_id} not found.", "error")
+                return redirect(url_for("ops.stock_counts_page"))
+            cur.execute(
+                """SELECT l.name AS location_name, p.product_name, p.sku,
+                          v.expected_quantity, v.counted_quantity,
+                          v.counted_quantity - v.expected_quantity AS variance
+                   FROM stock_count_variances v
+                   JOIN locations l ON v.location_id = l.id
+                   JOIN products p ON v.product_id = p.id
+                   WHERE v.stock_count_id = %s
+                   ORDER BY l.name, p.product_name, p.sku;""",
+                (count_id,),
+            )
+            variances = cur.fetchall()
+    except psycopg2.Error as e:
+        flash(f"Error fetching stock count: {e}", "error")
+        print(f"DB Error stock count detail {count_id}: {e}")
+        return redirect(url_for("ops.stock_counts_page"))
+
+    release_db()
+    return render_template(
+        "stock_count_detail.html",
+        count=count,
+        variances=variances,
+        shortfall=sum(v["variance"] for v in variances if v["variance"] < 0),
+        surplus=sum(v["variance"] for v in variances if v["variance"] > 0),
+    )
+
+
 @bp.route("/stock-transfer", methods=["GET", "POST"])
 def stock_transfer():
     conn = get_db()
@@ -201,6 +343,7 @@ def stock_transfer():
                     DO UPDATE SET quantity = location_stock.quantity + EXCLUDED.quantity;""",
                     (product_id, to_location_id, quantity),
                 )
+                bump_version(cur, "location_stock")
                 conn.commit()
                 flash(f"Successfully transferred {quantity} units.", "success")
             return redirect(url_for("ops.stock_transfer"))
@@ -304,6 +447,7 @@ def process_adjustment(id):
             _log_inventory_adjustment(
                 cur, id, adjustment_quantity, reason, new_quantity_on_hand
             )
+            bump_version(cur, "inventory")
             conn.commit()
             flash(
                 f"Inventory adjusted by {adjustment_quantity}. New QOH: {round(new_quantity_on_hand, 2)}",
@@ -322,48 +466,197 @@ def process_adjustment(id):
     return redirect(url_for("data.inventory_items_page"))
 
 
-@bp.route("/inventory-log")
-def inventory_log():
-    conn = get_db()
-    adjustments = []
-    inventory_items = []
+LOG_PAGE_SIZE = 100
+LOG_EXPORT_FETCH_SIZE = 2000
+LOG_EXPORT_COLUMNS = [
+    "id",
+    "adjustment_date",
+    "item_name",
+    "change_quantity",
+    "new_quantity",
+    "reason",
+]
+
+
+def _encode_log_cursor(row):
+    return f"{row['adjustment_date'].isoformat()}_{row['id']}"
+
+
+def _decode_log_cursor(value):
+    created_at_str, id_str = value.rsplit("_", 1)
+    return datetime.fromisoformat(created_at_str), int(id_str)
+
+
+def _inventory_log_filters():
+    """
+    Parses the inventory log filters from the query string.
+    Returns (where clauses, params, filters for the template).
+    """
+    filters = {
+        "inventory_item_id": None,
+        "date_from": request.args.get("date_from") or "",
+        "date_to": request.args.get("date_to") or "",
+        "reason": (request.args.get("reason") or "").strip(),
+    }
+    clauses = []
+    params = []
+
     filter_item_id_str = request.args.get("inventory_item_id")
-    filter_item_id = None
     if filter_item_id_str:
         try:
-            filter_item_id = int(filter_item_id_str)
+            filters["inventory_item_id"] = int(filter_item_id_str)
+            clauses.append("ia.inventory_item_id = %s")
+            params.append(filters["inventory_item_id"])
         except ValueError:
             flash("Invalid item ID for filtering.", "warning")
-            filter_item_id = None
+
+    for key, clause in (
+        ("date_from", "ia.created_at >= %s"),
+        ("date_to", "ia.created_at < %s::date + 1"),
+    ):
+        if filters[key]:
+            try:
+                params.append(datetime.strptime(filters[key], "%Y-%m-%d").date())
+                clauses.append(clause)
+            except ValueError:
+                flash(f"Invalid date '{filters[key]}'.", "warning")
+                filters[key] = ""
+
+    if filters["reason"]:
+        clauses.append("ia.reason ILIKE %s")
+        params.append(f"%{filters['reason']}%")
+
+    return clauses, params, filters
+
+
+_INVENTORY_LOG_SELECT = """
+    SELECT
+        ia.id, ia.created_at AS adjustment_date, ii.name AS item_name,
+        ia.adjustment_quantity AS change_quantity, ia.new_quantity, ia.reason
+    FROM inventory_adjustments ia
+    JOIN inventory_items ii ON ia.inventory_item_id = ii.id
+"""
+
+
+@bp.route("/inventory-log")
+def inventory_log():
+    conn = get_db(read_only=True)
+    adjustments = []
+    inventory_items = []
+    next_cursor = None
+    prev_cursor = None
+    clauses, params, filters = _inventory_log_filters()
+
+    # Keyset pagination on (created_at, id): 'after' pages towards older
+    # rows, 'before' pages back towards newer ones.
+    after = request.args.get("after")
+    before = request.args.get("before")
+    order = "DESC"
+    try:
+        if after:
+            clauses.append("(ia.created_at, ia.id) < (%s, %s)")
+            params.extend(_decode_log_cursor(after))
+        elif before:
+            clauses.append("(ia.created_at, ia.id) > (%s, %s)")
+            params.extend(_decode_log_cursor(before))
+            order = "ASC"
+    except ValueError:
+        flash("Invalid page marker; showing the newest entries.", "warning")
+        after = before = None
 
     try:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         cursor.execute("SELECT id, name, unit FROM inventory_items ORDER BY name;")
         inventory_items = cursor.fetchall()
-        query_sql = """
-            SELECT 
-                ia.id, ia.created_at AS adjustment_date, ii.name AS item_name,
-                ia.adjustment_quantity AS change_quantity, ia.new_quantity, ia.reason
-            FROM inventory_adjustments ia
-            JOIN inventory_items ii ON ia.inventory_item_id = ii.id
-        """
-        params = []
-        if filter_item_id:
-            query_sql += " WHERE ia.inventory_item_id = %s"
-            params.append(filter_item_id)
-        query_sql += " ORDER BY ia.created_at DESC"
-        cursor.execute(query_sql, tuple(params))
+        query_sql = _INVENTORY_LOG_SELECT
+        if clauses:
+            query_sql += " WHERE " + " AND ".join(clauses)
+        query_sql += f" ORDER BY ia.created_at {order}, ia.id {order} LIMIT %s"
+        cursor.execute(query_sql, tuple(params) + (LOG_PAGE_SIZE + 1,))
         adjustments = cursor.fetchall()
         cursor.close()
+
+        has_more = len(adjustments) > LOG_PAGE_SIZE
+        adjustments = adjustments[:LOG_PAGE_SIZE]
+        if order == "ASC":
+            adjustments.reverse()
+        if adjustments:
+            if has_more or before:
+                next_cursor = _encode_log_cursor(adjustments[-1])
+            if after or (before and has_more):
+                prev_cursor = _encode_log_cursor(adjustments[0])
     except Exception as e:
         flash(f"Error fetching inventory log: {e}", "danger")
         print(f"Error fetching inventory log: {e}")
 
+    release_db()
     return render_template(
         "inventory_log.html",
         adjustments=adjustments,
         inventory_items=inventory_items,
-        selected_item_id=filter_item_id,
+        selected_item_id=filters["inventory_item_id"],
+        filters=filters,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
+    )
+
+
+@bp.route("/inventory-log/export")
+def export_inventory_log():
+    """
+    Streams the (filtered) inventory log as CSV or NDJSON. Rows come from a
+    server-side cursor in batches, so memory use stays flat however long
+    the log is.
+    """
+    export_format = request.args.get("format", "csv")
+    if export_format not in ("csv", "ndjson"):
+        flash("Unsupported export format.", "error")
+        return redirect(url_for("ops.inventory_log"))
+
+    clauses, params, _ = _inventory_log_filters()
+    query_sql = _INVENTORY_LOG_SELECT
+    if clauses:
+        query_sql += " WHERE " + " AND ".join(clauses)
+    query_sql += " ORDER BY ia.created_at DESC, ia.id DESC"
+
+    conn = get_db()
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == "csv":
+            writer.writerow(LOG_EXPORT_COLUMNS)
+
+        cursor = conn.cursor(name="inventory_log_export", cursor_factory=RealDictCursor)
+        cursor.itersize = LOG_EXPORT_FETCH_SIZE
+        try:
+            cursor.execute(query_sql, tuple(params))
+            for count, row in enumerate(cursor, start=1):
+                values = [row[col] for col in LOG_EXPORT_COLUMNS]
+                values[1] = values[1].isoformat() if values[1] else None
+                if export_format == "csv":
+                    writer.writerow(values)
+                else:
+                    buffer.write(
+                        json.dumps(dict(zip(LOG_EXPORT_COLUMNS, values)), default=str)
+                        + "\n"
+                    )
+                if count % LOG_EXPORT_FETCH_SIZE == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        finally:
+            cursor.close()
+            conn.rollback()
+
+    extension = "csv" if export_format == "csv" else "ndjson"
+    mimetype = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    filename = f"inventory_log_{datetime.now():%Y%m%d_%H%M%S}.{extension}"
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
     )
 
 
@@ -425,6 +718,7 @@ def wip_batches_page():
                 else:
                     flash("Invalid batch type.", "error")
                     raise ValueError("Invalid batch type")
+                bump_version(cur, "wip")
 
             conn.commit()
             return redirect(url_for("ops.wip_batches_page"))
@@ -437,7 +731,7 @@ def wip_batches_page():
                     w.id, w.created_at, w.batch_type,
                     r.name as recipe_name,
                     p.product_name,
-                    i.name as item_name
+                    i.name as item_name, i.unit as item_unit
                 FROM wip_batches w 
                 JOIN recipes r ON w.recipe_id = r.id
                 LEFT JOIN products p ON w.product_id = p.id
@@ -496,8 +790,6 @@ def wip_batch_detail(batch_id):
     ingredient_summary = []
     yield_label = "Actual Yield"
 
-    recipe_cache = {}
-
     try:
         with conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute(
@@ -524,69 +816,35 @@ def wip_batch_detail(batch_id):
             elif batch["batch_type"] == "INTERMEDIATE":
                 yield_label = f"Actual Yield ({batch['item_unit']})"
 
-            required_ingredients = defaultdict(
-                lambda: {
-                    "name": "",
-                    "unit": "",
-                    "total_needed": 0,
-                    "inventory_item_id": None,
-                }
-            )
-            base_ingredients_one_batch = get_base_ingredients(
-                batch["recipe_id"], conn, recipe_cache
-            )
-            batches_needed_float = 1.0
-
-            for ing in base_ingredients_one_batch:
-                inv_item_id = ing.get("inventory_item_id")
-                if inv_item_id:
-                    name = ing.get("name", "?").strip()
-                    unit = ing.get("unit", "?").strip()
-                    key = inv_item_id
-                    required_ingredients[key]["name"] = name
-                    required_ingredients[key]["unit"] = unit
-                    required_ingredients[key]["inventory_item_id"] = inv_item_id
-                    required_ingredients[key]["total_needed"] += (
-                        float(ing.get("quantity", 0)) * batches_needed_float
-                    )
-
-            cur.execute(
-                """SELECT inventory_item_id, SUM(quantity_allocated) as total_allocated 
-                   FROM wip_allocations 
-                   WHERE wip_batch_id = %s GROUP BY inventory_item_id;""",
-                (batch_id,),
-            )
-            allocations_raw = cur.fetchall()
-            current_allocations = {
-                alloc["inventory_item_id"]: alloc["total_allocated"]
-                for alloc in allocations_raw
-            }
-
-            # --- NEW: Get all available inventory in one go ---
+            # One batch's base ingredients come from the materialized BOM.
             cur.execute(
-                "SELECT id, (quantity_on_hand - quantity_allocated) as available FROM inventory_items;"
+                """SELECT rbi.inventory_item_id, inv.name, inv.unit,
+                          rbi.quantity AS total_needed,
+                          COALESCE(a.total_allocated, 0) AS allocated,
+                          inv.quantity_on_hand - inv.quantity_allocated AS available
+                   FROM recipe_base_ingredients rbi
+                   JOIN inventory_items inv ON inv.id = rbi.inventory_item_id
+                   LEFT JOIN (
+                       SELECT inventory_item_id, SUM(quantity_allocated) AS total_allocated
+                       FROM wip_allocations
+                       WHERE wip_batch_id = %s
+                       GROUP BY inventory_item_id
+                   ) a ON a.inventory_item_id = rbi.inventory_item_id
+                   WHERE rbi.recipe_id = %s;""",
+                (batch_id, batch["recipe_id"]),
             )
-            available_stock_raw = cur.fetchall()
-            available_stock_map = {
-                item["id"]: float(item["available"]) for item in available_stock_raw
-            }
-
-            for inv_id, req in required_ingredients.items():
-                allocated = float(current_allocations.get(inv_id, 0))
-                remaining = float(req["total_needed"]) - allocated
-
-                # --- NEW: Find the available stock for this item ---
-                available = available_stock_map.get(inv_id, 0)
-
+            for row in cur.fetchall():
+                needed = float(row["total_needed"])
+                allocated = float(row["allocated"])
                 ingredient_summary.append(
                     {
-                        "inventory_item_id": inv_id,
-                        "name": req["name"],
-                        "unit": req["unit"],
-                        "needed": round(float(req["total_needed"]), 2),
+                        "inventory_item_id": row["inventory_item_id"],
+                        "name": row["name"].strip(),
+                        "unit": row["unit"].strip(),
+                        "needed": round(needed, 2),
                         "allocated": round(allocated, 2),
-                        "remaining": round(remaining, 2),
-                        "available": round(available, 2),  # --- NEWLY ADDED ---
+                        "remaining": round(needed - allocated, 2),
+                        "available": round(float(row["available"]), 2),
                     }
                 )
             ingredient_summary.sort(key=lambda x: x["name"])
@@ -608,15 +866,17 @@ def wip_batch_detail(batch_id):
 def allocate_bulk(batch_id):
     conn = get_db()
 
-    # 1. Parse the form into a list of tasks
-    allocations_to_make = []
+    # 1. Parse the form into item id -> quantity
+    allocations_to_make = {}
     for key, value in request.form.items():
         if key.startswith("alloc-"):
             try:
                 item_id = int(key.split("-")[-1])
                 quantity = float(value)
                 if quantity > 0:
-                    allocations_to_make.append({"id": item_id, "qty": quantity})
+                    allocations_to_make[item_id] = (
+                        allocations_to_make.get(item_id, 0) + quantity
+                    )
             except (ValueError, TypeError):
                 flash(f"Invalid quantity '{value}' submitted.", "error")
                 return redirect(url_for("ops.wip_batch_detail", batch_id=batch_id))
@@ -627,33 +887,10 @@ def allocate_bulk(batch_id):
 
     try:
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            # 2. Check all items for stock within a single transaction
-            for task in allocations_to_make:
-                cur.execute(
-                    "SELECT name, (quantity_on_hand - quantity_allocated) as available FROM inventory_items WHERE id = %s FOR UPDATE;",
-                    (task["id"],),
-                )
-                item = cur.fetchone()
-                if not item:
-                    raise Exception(f"Item ID {task['id']} not found.")
-                if item["available"] < task["qty"]:
-                    raise Exception(
-                        f"Not enough stock for '{item['name']}'. Available: {item['available']}, Tried to allocate: {task['qty']}"
-                    )
-
-            # 3. If all checks passed, perform all allocations
-            for task in allocations_to_make:
-                # Add to allocation table
-                cur.execute(
-                    "INSERT INTO wip_allocations (wip_batch_id, inventory_item_id, quantity_allocated) VALUES (%s, %s, %s);",
-                    (batch_id, task["id"], task["qty"]),
-                )
-                # Update inventory allocated quantity
-                cur.execute(
-                    "UPDATE inventory_items SET quantity_allocated = quantity_allocated + %s WHERE id = %s;",
-                    (task["qty"], task["id"]),
-                )
+            # 2. Lock, check and allocate every item with a fixed number of statements
+            allocate_to_batch(cur, batch_id, allocations_to_make)
 
+            bump_version(cur, "wip", "inventory")
             conn.commit()
             flash(
                 f"Successfully allocated {len(allocations_to_make)} item(s).", "success"
@@ -682,95 +919,67 @@ def complete_wip_batch(batch_id):
 
     try:
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(
-                "SELECT w.*, i.unit as item_unit FROM wip_batches w "
-                "LEFT JOIN inventory_items i ON w.inventory_item_id = i.id "
-                "WHERE w.id = %s FOR UPDATE;",
-                (batch_id,),
-            )
-            batch = cur.fetchone()
-            if not batch or batch["status"] != "In Progress":
-                flash("Batch not found or already completed.", "error")
-                raise Exception("Batch not found or not in progress")
+            (completed,) = complete_wip_batches(cur, {batch_id: actual_yield})
+            bump_version(cur, "wip", "inventory", "location_stock")
+        conn.commit()
+        flash(_completion_message(completed), "success")
+    except ValueError as e:
+        conn.rollback()
+        flash(str(e), "error")
+        return redirect(url_for("ops.wip_batch_detail", batch_id=batch_id))
+    except psycopg2.Error as e:
+        conn.rollback()
+        flash(f"DB error completing batch: {e}", "error")
+        print(f"DB Error complete batch {batch_id}: {e}")
+        return redirect(url_for("ops.wip_batch_detail", batch_id=batch_id))
 
-            cur.execute(
-                "SELECT inventory_item_id, SUM(quantity_allocated) as total_allocated FROM wip_allocations WHERE wip_batch_id = %s GROUP BY inventory_item_id;",
-                (batch_id,),
-            )
-            allocations = cur.fetchall()
-            if not allocations:
-                flash("Cannot complete batch: No ingredients were allocated.", "error")
-                raise Exception("No ingredients allocated")
-
-            for alloc in allocations:
-                adj_qty = -alloc["total_allocated"]
-                reason = f"WIP Batch #{batch_id} Completed"
-                cur.execute(
-                    """UPDATE inventory_items 
-                    SET quantity_on_hand = quantity_on_hand - %s, 
-                    quantity_allocated = quantity_allocated - %s 
-                    WHERE id = %s 
-                    RETURNING quantity_on_hand;""",
-                    (
-                        alloc["total_allocated"],
-                        alloc["total_allocated"],
-                        alloc["inventory_item_id"],
-                    ),
-                )
-                updated_qty_row = cur.fetchone()
-                new_qoh = updated_qty_row[0] if updated_qty_row else 0
-                _log_inventory_adjustment(
-                    cur,
-                    alloc["inventory_item_id"],
-                    adj_qty,
-                    reason,
-                    new_qoh,
-                    wip_batch_id=batch_id,
-                )
+    return redirect(url_for("ops.wip_batches_page"))
 
-            if batch["batch_type"] == "PRODUCT":
-                cur.execute(
-                    """INSERT INTO location_stock (product_id, location_id, quantity)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (product_id, location_id)
-                    DO UPDATE SET quantity = location_stock.quantity + EXCLUDED.quantity;""",
-                    (batch["product_id"], batch["location_id"], actual_yield),
-                )
-                yield_unit = "jars"
-                flash_msg = f"Batch {batch_id} completed. {actual_yield} jars added to location stock."
 
-            elif batch["batch_type"] == "INTERMEDIATE":
-                reason = f"WIP Batch #{batch_id} Completed (Yield)"
-                cur.execute(
-                    "UPDATE inventory_items SET quantity_on_hand = quantity_on_hand + %s WHERE id = %s RETURNING quantity_on_hand;",
-                    (actual_yield, batch["inventory_item_id"]),
-                )
-                updated_qty_row = cur.fetchone()
-                new_qoh = updated_qty_row[0] if updated_qty_row else 0
-                _log_inventory_adjustment(
-                    cur,
-                    batch["inventory_item_id"],
-                    actual_yield,
-                    reason,
-                    new_qoh,
-                    wip_batch_id=batch_id,
-                )
-                yield_unit = batch["item_unit"]
-                flash_msg = f"Batch {batch_id} completed. {actual_yield} {yield_unit} added to raw ingredient stock."
+def _completion_message(completed):
+    if completed["batch_type"] == "PRODUCT":
+        return f"Batch {completed['id']} completed. {completed['actual_yield']} jars added to location stock."
+    return f"Batch {completed['id']} completed. {completed['actual_yield']} {completed['yield_unit']} added to raw ingredient stock."
 
-            cur.execute(
-                "UPDATE wip_batches SET status = 'Completed', completed_at = NOW(), actual_yield = %s, actual_yield_unit = %s WHERE id = %s;",
-                (actual_yield, yield_unit, batch_id),
-            )
+
+@bp.route("/wip/complete-bulk", methods=["POST"])
+def complete_wip_batches_bulk():
+    """
+    Completes every batch with a yield entered on the WIP list, in one
+    transaction. Nothing is completed if any batch fails.
+    """
+    conn = get_db()
+    yields = {}
+    for key, value in request.form.items():
+        if not key.startswith("yield-") or not value.strip():
+            continue
+        try:
+            batch_id = int(key.split("-", 1)[1])
+            actual_yield = float(value)
+            if actual_yield < 0:
+                raise ValueError("Yield cannot be negative")
+        except ValueError:
+            flash(f"Invalid yield '{value}' for {key}.", "error")
+            return redirect(url_for("ops.wip_batches_page"))
+        yields[batch_id] = actual_yield
+
+    if not yields:
+        flash("No yields entered.", "warning")
+        return redirect(url_for("ops.wip_batches_page"))
+
+    try:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            completed = complete_wip_batches(cur, yields)
+            bump_version(cur, "wip", "inventory", "location_stock")
         conn.commit()
-        flash(flash_msg, "success")
-    except Exception as e:
-        if conn:
-            conn.rollback()
-        if "No ingredients" not in str(e):
-            flash(f"DB error completing batch: {e}", "error")
-        print(f"DB Error complete batch {batch_id}: {e}")
-        return redirect(url_for("ops.wip_batch_detail", batch_id=batch_id))
+        flash(f"Completed {len(completed)} batch(es).", "success")
+    except ValueError as e:
+        conn.rollback()
+        flash(f"No batches completed: {e}", "error")
+    except psycopg2.Error as e:
+        conn.rollback()
+        flash(f"DB error completing batches: {e}", "error")
+        print(f"DB Error bulk complete batches: {e}")
 
     return redirect(url_for("ops.wip_batches_page"))
 
@@ -807,6 +1016,7 @@ def delete_wip_batch(batch_id):
                 # --- END FIX ---
 
                 cur.execute("DELETE FROM wip_batches WHERE id = %s;", (batch_id,))
+                bump_version(cur, "wip", "inventory")
                 conn.commit()
                 flash(f"WIP Batch {batch_id} deleted.", "success")
     except psycopg2.Error as e:
@@ -818,10 +1028,24 @@ def delete_wip_batch(batch_id):
 
 
 # --- Purchase Order (PO) Routes ---
+PURCHASE_ORDER_LIST = ListQuery(
+    """SELECT po.id, s.name AS supplier_name, po.order_date,
+              po.expected_delivery_date, po.status
+       FROM purchase_orders po JOIN suppliers s ON po.supplier_id = s.id""",
+    sorts={
+        "status": [("status", False), ("order_date", True), ("id", True)],
+        "order_date": [("order_date", True), ("id", True)],
+        "id": [("id", True)],
+    },
+    default_sort="status",
+    search=["supplier_name", "status", "CAST(id AS TEXT)"],
+)
+
+
 @bp.route("/purchase-orders", methods=["GET", "POST"])
 def purchase_orders_page():
     conn = get_db()
-    purchase_orders = []
+    purchase_orders = PURCHASE_ORDER_LIST.empty()
     suppliers = []
     try:
         if request.method == "POST":
@@ -851,20 +1075,16 @@ def purchase_orders_page():
                     (supplier_id, order_date, expected_delivery, "Placed"),
                 )
                 new_po_id = cur.fetchone()["id"]
+                bump_version(cur, "purchase_orders")
                 conn.commit()
                 flash("Purchase Order created. Now add items.", "success")
                 return redirect(url_for("ops.po_detail", po_id=new_po_id))
 
         # GET Request Logic
+        purchase_orders, error = PURCHASE_ORDER_LIST.fetch(conn)
+        if error:
+            flash(error, "warning")
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute(
-                """
-                SELECT po.id, s.name as supplier_name, po.order_date, po.expected_delivery_date, po.status
-                FROM purchase_orders po JOIN suppliers s ON po.supplier_id = s.id
-                ORDER BY po.status, po.order_date DESC, po.id DESC;
-            """
-            )
-            purchase_orders = cur.fetchall()
             cur.execute("SELECT id, name FROM suppliers ORDER BY name;")
             suppliers = cur.fetchall()
 
@@ -891,12 +1111,47 @@ def purchase_orders_page():
     )
 
 
+@bp.route("/purchase-orders/receive", methods=["POST"])
+def receive_purchase_orders_bulk():
+    """
+    Receives every selected purchase order in one transaction.
+    """
+    conn = get_db()
+    try:
+        po_ids = [int(po_id) for po_id in request.form.getlist("po_ids")]
+    except ValueError:
+        flash("Invalid purchase order selection.", "error")
+        return redirect(url_for("ops.purchase_orders_page"))
+
+    if not po_ids:
+        flash("No purchase orders selected.", "warning")
+        return redirect(url_for("ops.purchase_orders_page"))
+
+    try:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            receive_purchase_orders(cur, po_ids)
+            bump_version(cur, "purchase_orders", "inventory")
+        conn.commit()
+        flash(
+            f"{len(set(po_ids))} purchase order(s) marked as Received. Inventory updated.",
+            "success",
+        )
+    except ValueError as e:
+        conn.rollback()
+        flash(f"No orders received: {e}", "error")
+    except psycopg2.Error as e:
+        conn.rollback()
+        flash(f"Database error receiving purchase orders: {e}", "error")
+        print(f"DB Error bulk PO receive: {e}")
+
+    return redirect(url_for("ops.purchase_orders_page"))
+
+
 @bp.route("/po/<int:po_id>")
 def po_detail(po_id):
     conn = get_db()
     po = None
     items = []
-    inventory_items = []
     total_cost = 0.0
     try:
         with conn.cursor(cursor_factory=DictCursor) as cur:
@@ -915,7 +1170,8 @@ def po_detail(po_id):
 
             cur.execute(
                 """
-                SELECT poi.id, inv.name, inv.unit, poi.quantity_ordered, poi.unit_cost
+                SELECT poi.id, inv.name, inv.unit, poi.quantity_ordered,
+                       poi.quantity_received, poi.unit_cost
                 FROM purchase_order_items poi
                 JOIN inventory_items inv ON poi.inventory_item_id = inv.id
                 WHERE poi.purchase_order_id = %s ORDER BY inv.name;
@@ -930,8 +1186,6 @@ def po_detail(po_id):
             total_cost = (
                 item_subtotal + float(po["shipping_cost"] or 0) + float(po["tax"] or 0)
             ) - float(po["discount"] or 0)
-            cur.execute("SELECT id, name, unit FROM inventory_items ORDER BY name;")
-            inventory_items = cur.fetchall()
 
     except psycopg2.Error as e:
         flash(f"Error fetching PO details: {e}", "error")
@@ -942,7 +1196,6 @@ def po_detail(po_id):
         "po_detail.html",
         po=po,
         items=items,
-        inventory_items=inventory_items,
         item_subtotal=item_subtotal,
         total_cost=total_cost,
     )
@@ -980,6 +1233,7 @@ def po_add_item(po_id):
             """,
                 (po_id, inventory_item_id, quantity_float, unit_cost_float),
             )
+            bump_version(cur, "purchase_orders")
         conn.commit()
         flash("Item added/updated successfully.", "success")
     except (psycopg2.Error, ValueError) as e:
@@ -1002,12 +1256,20 @@ def po_remove_item(item_id):
         with conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute("SELECT status FROM purchase_orders WHERE id = %s;", (po_id,))
             po_status_row = cur.fetchone()
+            cur.execute(
+                "SELECT quantity_received FROM purchase_order_items WHERE id = %s;",
+                (item_id,),
+            )
+            line = cur.fetchone()
             if po_status_row and po_status_row["status"] == "Received":
                 flash("Cannot remove items from a received order.", "error")
+            elif line and line["quantity_received"] > 0:
+                flash("Cannot remove an item that has already been received.", "error")
             else:
                 cur.execute(
                     "DELETE FROM purchase_order_items WHERE id = %s;", (item_id,)
                 )
+                bump_version(cur, "purchase_orders")
                 conn.commit()
                 flash("Item removed from PO.", "success")
     except psycopg2.Error as e:
@@ -1019,6 +1281,51 @@ def po_remove_item(item_id):
     return redirect(url_for("ops.po_detail", po_id=po_id))
 
 
+@bp.route("/po/<int:po_id>/receive", methods=["POST"])
+def po_receive_lines(po_id):
+    """
+    Records a delivery against a PO: every line with a quantity entered is
+    received in one transaction. Inventory moves only by what arrived.
+    """
+    conn = get_db()
+    quantities = {}
+    for key, value in request.form.items():
+        if not key.startswith("receive-") or not value.strip():
+            continue
+        try:
+            line_id = int(key.split("-", 1)[1])
+            quantity = float(value)
+            if quantity <= 0:
+                raise ValueError("Quantity must be positive.")
+        except ValueError:
+            flash(f"Invalid received quantity '{value}'.", "error")
+            return redirect(url_for("ops.po_detail", po_id=po_id))
+        quantities[line_id] = quantity
+
+    if not quantities:
+        flash("No received quantities entered.", "warning")
+        return redirect(url_for("ops.po_detail", po_id=po_id))
+
+    try:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            completed = receive_po_lines(cur, po_id, quantities)
+            bump_version(cur, "purchase_orders", "inventory")
+        conn.commit()
+        if completed:
+            flash("All items received. Order marked as Received.", "success")
+        else:
+            flash(f"Received {len(quantities)} line(s). Inventory updated.", "success")
+    except ValueError as e:
+        conn.rollback()
+        flash(str(e), "error")
+    except psycopg2.Error as e:
+        conn.rollback()
+        flash(f"Database error receiving items: {e}", "error")
+        print(f"DB Error PO receive lines {po_id}: {e}")
+
+    return redirect(url_for("ops.po_detail", po_id=po_id))
+
+
 @bp.route("/po/<int:po_id>/update-details", methods=["POST"])
 def po_update_header(po_id):
     conn = get_db()
@@ -1044,7 +1351,9 @@ def po_update_header(po_id):
         )
 
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("SELECT status FROM purchase_orders WHERE id = %s;", (po_id,))
+            cur.execute(
+                "SELECT status FROM purchase_orders WHERE id = %s FOR UPDATE;", (po_id,)
+            )
             current_status_row = cur.fetchone()
             if not current_status_row:
                 flash("PO not found.", "error")
@@ -1071,34 +1380,14 @@ def po_update_header(po_id):
                 ),
             )
 
+            moved_lines = []
             if new_status == "Received" and current_status != "Received":
-                cur.execute(
-                    "SELECT inventory_item_id, quantity_ordered FROM purchase_order_items WHERE purchase_order_id = %s;",
-                    (po_id,),
-                )
-                items_to_receive = cur.fetchall()
-                if not items_to_receive:
+                moved_lines = move_po_stock(cur, [po_id], 1, "PO #{po_id} Received")
+                if not moved_lines:
                     flash("Cannot mark empty order as Received.", "warning")
                     conn.rollback()
                     return redirect(url_for("ops.po_detail", po_id=po_id))
 
-                for item in items_to_receive:
-                    adj_qty = item["quantity_ordered"]
-                    reason = f"PO #{po_id} Received"
-                    cur.execute(
-                        "UPDATE inventory_items SET quantity_on_hand = quantity_on_hand + %s WHERE id = %s RETURNING quantity_on_hand;",
-                        (adj_qty, item["inventory_item_id"]),
-                    )
-                    updated_qty_row = cur.fetchone()
-                    new_qoh = updated_qty_row[0] if updated_qty_row else 0
-                    _log_inventory_adjustment(
-                        cur,
-                        item["inventory_item_id"],
-                        adj_qty,
-                        reason,
-                        new_qoh,
-                        po_id=po_id,
-                    )
                 cur.execute(
                     "UPDATE purchase_orders SET received_at = NOW() WHERE id = %s;",
                     (po_id,),
@@ -1106,28 +1395,9 @@ def po_update_header(po_id):
                 flash("Order marked as Received. Inventory updated.", "success")
 
             elif new_status != "Received" and current_status == "Received":
-                cur.execute(
-                    "SELECT inventory_item_id, quantity_ordered FROM purchase_order_items WHERE purchase_order_id = %s;",
-                    (po_id,),
+                moved_lines = move_po_stock(
+                    cur, [po_id], -1, "PO #{po_id} Status Reverted (Un-Received)"
                 )
-                items_to_unreceive = cur.fetchall()
-                for item in items_to_unreceive:
-                    adj_qty = -item["quantity_ordered"]
-                    reason = f"PO #{po_id} Status Reverted (Un-Received)"
-                    cur.execute(
-                        "UPDATE inventory_items SET quantity_on_hand = quantity_on_hand - %s WHERE id = %s RETURNING quantity_on_hand;",
-                        (item["quantity_ordered"], item["inventory_item_id"]),
-                    )
-                    updated_qty_row = cur.fetchone()
-                    new_qoh = updated_qty_row[0] if updated_qty_row else 0
-                    _log_inventory_adjustment(
-                        cur,
-                        item["inventory_item_id"],
-                        adj_qty,
-                        reason,
-                        new_qoh,
-                        po_id=po_id,
-                    )
                 cur.execute(
                     "UPDATE purchase_orders SET received_at = NULL WHERE id = %s;",
                     (po_id,),
@@ -1138,6 +1408,11 @@ def po_update_header(po_id):
                 )
             else:
                 flash("PO details updated.", "success")
+            # Only a status change that actually moved stock touches inventory.
+            if any(line["quantity"] for line in moved_lines):
+                bump_version(cur, "purchase_orders", "inventory")
+            else:
+                bump_version(cur, "purchase_orders")
         conn.commit()
 
     except Exception as e:
@@ -1163,29 +1438,12 @@ def po_delete(po_id):
                 flash("PO not found.", "error")
                 conn.rollback()
             else:
-                if po["status"] == "Received" or po["received_at"] is not None:
-                    cur.execute(
-                        "SELECT inventory_item_id, quantity_ordered FROM purchase_order_items WHERE purchase_order_id = %s;",
-                        (po_id,),
-                    )
-                    items_to_unreceive = cur.fetchall()
-                    for item in items_to_unreceive:
-                        adj_qty = -item["quantity_ordered"]
-                        reason = f"PO #{po_id} Deleted (Reversal)"
-                        cur.execute(
-                            "UPDATE inventory_items SET quantity_on_hand = quantity_on_hand - %s WHERE id = %s RETURNING quantity_on_hand;",
-                            (item["quantity_ordered"], item["inventory_item_id"]),
-                        )
-                        updated_qty_row = cur.fetchone()
-                        new_qoh = updated_qty_row[0] if updated_qty_row else 0
-                        _log_inventory_adjustment(
-                            cur,
-                            item["inventory_item_id"],
-                            adj_qty,
-                            reason,
-                            new_qoh,
-                            po_id=po_id,
-                        )
+                # Reverses full and partial receipts alike.
+                reversed_lines = move_po_stock(
+                    cur, [po_id], -1, "PO #{po_id} Deleted (Reversal)"
+                )
+                stock_moved = any(line["quantity"] for line in reversed_lines)
+                if stock_moved:
                     flash_msg = "PO deleted. Inventory updates have been reversed."
                 else:
                     flash_msg = "PO deleted."
@@ -1198,6 +1456,10 @@ def po_delete(po_id):
                 # --- END FIX ---
 
                 cur.execute("DELETE FROM purchase_orders WHERE id = %s;", (po_id,))
+                if stock_moved:
+                    bump_version(cur, "purchase_orders", "inventory")
+                else:
+                    bump_version(cur, "purchase_orders")
                 conn.commit()
                 flash(flash_msg, "success")
     except psycopg2.Error as e:
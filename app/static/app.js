@@ -51,9 +51,7 @@ document.addEventListener("DOMContentLoaded", () => {
   });
 
   // --- Initialize all Select2 elements ---
-  if (typeof $ !== "undefined") {
-    $(".select2-enable").select2({ theme: "default" });
-  }
+  initializeSelect2(".select2-enable");
 
   // --- Flash Message Fade-out ---
   const allFlashMessages = document.querySelectorAll(
@@ -100,9 +98,102 @@ document.addEventListener("DOMContentLoaded", () => {
   });
 });
 
+// Select2 options for one <select>. Selects with a data-autocomplete-url
+// load their options from that JSON endpoint as the user types, instead
+// of shipping every option in the page.
+function select2Options(select) {
+  const options = { theme: "default" };
+  const url = select.dataset.autocompleteUrl;
+  if (url) {
+    options.ajax = {
+      url: url,
+      dataType: "json",
+      delay: 250,
+      cache: true,
+      data: (params) => ({ q: params.term || "", page: params.page || 1 }),
+    };
+    options.placeholder = select.dataset.placeholder || "";
+    options.allowClear = !select.required;
+  }
+  return options;
+}
+
 // Make Select2 init globally available for dynamic rows
 function initializeSelect2(selector) {
   if (typeof $ !== "undefined") {
-    $(selector).select2({ theme: "default" });
+    $(selector).each(function () {
+      $(this).select2(select2Options(this));
+    });
   }
 }
+
+// --- Production Planner: live requirements while typing ---
+document.addEventListener("DOMContentLoaded", () => {
+  const plannerForm = document.getElementById("planner-form");
+  const results = document.getElementById("planner-results");
+  if (!plannerForm || !results) return;
+
+  const table = results.querySelector("table");
+  const tbody = table.querySelector("tbody");
+  const emptyMessage = results.querySelector(".planner-empty");
+  let debounceTimer = null;
+  let inFlight = null;
+
+  const cell = (text, className) => {
+    const td = document.createElement("td");
+    td.textContent = text;
+    if (className) td.className = className;
+    return td;
+  };
+
+  const render = (requirements) => {
+    tbody.replaceChildren(
+      ...requirements.map((item) => {
+        const tr = document.createElement("tr");
+        tr.append(
+          cell(item.name),
+          cell(item.unit),
+          cell(item.total_needed),
+          cell(item.available),
+          cell(item.net_needed, item.net_needed > 0 ? "highlight-needed" : "")
+        );
+        return tr;
+      })
+    );
+    results.hidden = false;
+    table.hidden = requirements.length === 0;
+    emptyMessage.hidden = requirements.length > 0;
+  };
+
+  const refresh = () => {
+    const jars = {};
+    plannerForm
+      .querySelectorAll("input[data-product-id]")
+      .forEach((input) => {
+        const value = parseInt(input.value, 10);
+        if (value > 0) jars[input.dataset.productId] = value;
+      });
+
+    // Only the latest request matters; drop any older one still running.
+    if (inFlight) inFlight.abort();
+    inFlight = new AbortController();
+    fetch(plannerForm.dataset.requirementsUrl, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(jars),
+      signal: inFlight.signal,
+    })
+      .then((response) => (response.ok ? response.json() : null))
+      .then((data) => {
+        if (data) render(data.requirements);
+      })
+      .catch((error) => {
+        if (error.name !== "AbortError") console.error(error);
+      });
+  };
+
+  plannerForm.addEventListener("input", () => {
+    clearTimeout(debounceTimer);
+    debounceTimer = setTimeout(refresh, 250);
+  });
+});
@@ -0,0 +1,108 @@
+import functools
+import hashlib
+
+import psycopg2
+from flask import make_response, request, session
+from werkzeug.http import is_resource_modified
+
+from app.db import get_db
+
+# --- Per-domain data versions (data_versions table) ---
+# Every write bumps the counters of the domains it touches inside its own
+# transaction, so a version only moves once the change is committed and
+# is shared by every worker process.
+
+DOMAINS = (
+    "inventory",
+    "recipes",
+    "products",
+    "stock_minimums",
+    "location_stock",
+    "purchase_orders",
+    "wip",
+    "suppliers",
+    "locations",
+)
+
+
+def bump_version(cur, *domains):
+    """Marks the given domains changed. Call before the write commits."""
+    cur.execute(
+        """UPDATE data_versions SET version = version + 1, changed_at = NOW()
+           WHERE domain = ANY(%s);""",
+        (sorted(domains),),
+    )
+
+
+def get_versions(conn, domains):
+    """
+    Returns ({domain: version}, latest changed_at) for the given domains.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT domain, version, changed_at FROM data_versions WHERE domain = ANY(%s);",
+            (list(domains),),
+        )
+        rows = cur.fetchall()
+    versions = {domain: version for domain, version, _ in rows}
+    changed_at = max((row[2] for row in rows), default=None)
+    return versions, changed_at
+
+
+def versions_key(conn, domains):
+    """Hashable stamp of the given domains, for keying server-side caches."""
+    versions, _ = get_versions(conn, domains)
+    return tuple(versions.get(domain, 0) for domain in domains)
+
+
+def versioned(*domains, vary=None):
+    """
+    Adds ETag/Last-Modified validators to a GET page built only from the
+    given domains, and answers 304 Not Modified when the browser's copy is
+    current, without running the view. 'vary' returns anything else the
+    page depends on (e.g. a session setting) to fold into the ETag.
+    Pages with pending flash messages are never cached.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped(*args, **kwargs):
+            if request.method != "GET" or session.get("_flashes"):
+                return view(*args, **kwargs)
+
+            conn = get_db(read_only=True)
+            try:
+                versions, changed_at = get_versions(conn, domains)
+            except psycopg2.Error as e:
+                # e.g. migrations not applied yet: serve the page uncached.
+                conn.rollback()
+                print(f"DB Error reading data versions: {e}")
+                return view(*args, **kwargs)
+
+            stamp = repr(
+                (
+                    request.full_path,
+                    sorted(versions.items()),
+                    vary() if vary else None,
+                )
+            )
+            etag = hashlib.sha1(stamp.encode()).hexdigest()
+            if not is_resource_modified(
+                request.environ, etag=etag, last_modified=changed_at
+            ):
+                response = make_response("", 304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            # Skip validators if the view flashed (and rendered) a message.
+            if response.status_code == 200 and not session.modified:
+                response.set_etag(etag)
+                if changed_at is not None:
+                    response.last_modified = changed_at
+                response.headers["Cache-Control"] = "no-cache"
+            return response
+
+        return wrapped
+
+    return decorator